@@ -0,0 +1,156 @@
+# analytic.py
+
+from fractions import Fraction
+import math
+import numpy as np
+
+# Largest degree whose gossip accuracy is found exactly by default: the
+# polynomials double in degree every round, so exact arithmetic costs about
+# 10x more per degree past this one
+EXACT_MAX_DEGREE = 9
+
+
+def gossip_first_spy_accuracy(degree, spreading_time, exact = None, tol = 1e-12):
+	''' Probability that the first-spy estimator catches the source of a
+	RegularTreeGossip of the given degree and spreading time (a Fraction if
+	exact, a float within about tol otherwise; exact by default up to
+	EXACT_MAX_DEGREE).
+
+	The source reports in a uniform round r among 1..degree+1, and the
+	estimator gets it right with probability 1/(1 + N) if no node reports
+	before r, where N is the number of other nodes that report in round r.
+	A node infected h rounds before r reaches the adversary in a uniform round
+	among the next degree, and each child in one of the others. Only the
+	children it reaches before r matter, and those are reached in rounds
+	1..h-1 after it whichever round the adversary gets, so the generating
+	function of N over its subtree (zero if the subtree reports before r) is
+
+		F_h(x) = (x + degree - h) / degree * P_h(x),  P_h = F_1 * ... * F_(h-1)
+
+	for h <= degree (F_h = 0 past it). The source's children are infected in
+	rounds 1..r-1 before it reports, so its accuracy is the mean over r of the
+	integral of P_r(x) over [0, 1], which is E[1 / (1 + N)]. P_(h+1) = P_h^2
+	(x + degree - h) / degree has degree 2^h - 1. Rounds past degree + 1 do
+	not change the accuracy. '''
+	if exact is None:
+		exact = degree <= EXACT_MAX_DEGREE
+	last_round = min(degree + 1, spreading_time)
+
+	if exact:
+		# P_r as integer coefficients (lowest power first) over degree^scale
+		total = Fraction(0)
+		(coefficients, scale) = (np.array([1], dtype = object), 0)
+		for r in range(1, last_round + 1):
+			numerator = sum([Fraction(int(c), power + 1) for (power, c) in enumerate(coefficients)])
+			total += numerator / degree ** scale
+			if r < last_round:
+				factor = np.convolve(coefficients, np.array([degree - r, 1], dtype = object))
+				(coefficients, scale) = (np.convolve(coefficients, factor), 2 * scale + 1)
+		return total / (degree + 1)
+
+	def integrands(x):
+		# P_r(x) for every r, one row each; the values underflow to 0 gently
+		rows = [np.ones_like(x)]
+		for r in range(1, last_round):
+			rows += [rows[-1] ** 2 * (x + degree - r) / degree]
+		return np.array(rows)
+	return float(integrate_unit_interval(integrands, tol).sum()) / (degree + 1)
+
+def integrate_unit_interval(f, tol, points = 20, max_splits = 12):
+	''' Integrals over [0, 1] of the rows of f(x), a vectorized function that
+	may peak sharply at 1: Gauss-Legendre rules on panels that shrink
+	geometrically towards 1, each split in two until the total moves by less
+	than tol '''
+	(nodes, weights) = np.polynomial.legendre.leggauss(points)
+	edges = np.concatenate([1 - 0.5 ** np.arange(60), [1.0]])
+
+	def integrate(edges):
+		(lo, hi) = (edges[:-1, None], edges[1:, None])
+		x = ((hi + lo) / 2 + (hi - lo) / 2 * nodes).ravel()
+		w = ((hi - lo) / 2 * weights).ravel()
+		return f(x).dot(w)
+
+	total = integrate(edges)
+	for _ in range(max_splits):
+		edges = np.sort(np.concatenate([edges, (edges[:-1] + edges[1:]) / 2]))
+		(previous, total) = (total, integrate(edges))
+		if np.abs(total - previous).max() <= tol:
+			return total
+	raise RuntimeError('the integral did not converge to %g' % tol)
+
+def exponential_convolution(values, step, scale):
+	''' Convolution of values, sampled from 0 on a grid of the given step and
+	taken to be linear between grid points, with the density of an
+	exponential delay of mean scale: the integral over 0 <= s <= x of
+	exp(-s / scale) / scale * values(x - s) at every grid point x. The
+	recursion across grid points is solved by cumulative sums, in blocks
+	short enough that the growing factors do not overflow. '''
+	decay = math.exp(-step / scale)
+	# Weights of the earlier and later grid point within one step
+	later = 1 - scale / step * (1 - decay)
+	inputs = np.concatenate([[0.0], (1 - decay - later) * values[:-1] + later * values[1:]])
+
+	result = np.empty_like(values, dtype = float)
+	block = max(1, int(30 * scale / step))
+	carried = 0.0
+	for start in range(0, len(values), block):
+		growth = decay ** -np.arange(1, min(block, len(values) - start) + 1)
+		# result[n] = decay * result[n - 1] + inputs[n] within the block
+		result[start:start + len(growth)] = (carried + np.cumsum(inputs[start:start + len(growth)] * growth)) / growth
+		carried = result[start + len(growth) - 1]
+	return result
+
+def diffusion_first_spy_accuracy(degree, spreading_time, tol = 1e-9, lambda1 = 1.0, lambda2 = 1.0,
+								 grid_points = 256, max_refinements = 12):
+	''' Probability that the first-spy estimator catches the source of a
+	RegularTreeDiffusion of the given degree and number of rings, within about
+	tol: the nodes of rings 0..spreading_time-1 report an exponential delay of
+	mean lambda2 after they receive the message, which crosses each edge after
+	an exponential delay of mean lambda1.
+
+	Let Q_m(u) be the probability that a node with m reporting rings below it,
+	and no node of its subtree, reports within u of the time it receives the
+	message, and C_m(u) the same for a subtree whose parent received the
+	message u earlier. Then Q_0(u) = exp(-u / lambda2),
+
+		Q_m(u) = exp(-u / lambda2) * C_(m-1)(u)^(degree - 1)
+		C_m(u) = exp(-u / lambda1) + (f1 * Q_m)(u)
+
+	where f1 is the density of the edge delay, and the accuracy is the
+	integral of f2(x) * C_(rings-2)(x)^degree over x >= 0, with f2 the density
+	of the source's report delay. The functions are sampled on a grid up to
+	where f2 has mass tol / 10 left, and the grid is halved until Romberg
+	extrapolation settles. '''
+	if spreading_time <= 1:
+		# Only the source reports
+		return 1.0
+	end = lambda2 * math.log(10.0 / tol)
+
+	def accuracy(num_points):
+		u = np.linspace(0, end, num_points + 1)
+		step = end / num_points
+		report = np.exp(-u / lambda2)
+		subtree = report
+		for ring in range(spreading_time - 2):
+			below = np.exp(-u / lambda1) + exponential_convolution(subtree, step, lambda1)
+			subtree = report * below ** (degree - 1)
+		below = np.exp(-u / lambda1) + exponential_convolution(subtree, step, lambda1)
+		integrand = report / lambda2 * below ** degree
+		return step * (integrand.sum() - (integrand[0] + integrand[-1]) / 2)
+
+	# Romberg table: row k uses grid_points * 2^k intervals
+	rows = [[accuracy(grid_points)]]
+	for k in range(1, max_refinements + 1):
+		row = [accuracy(grid_points * 2 ** k)]
+		for j in range(1, k + 1):
+			row += [row[j - 1] + (row[j - 1] - rows[-1][j - 1]) / (4 ** j - 1)]
+		rows += [row]
+		if abs(row[-1] - rows[-2][-1]) <= tol:
+			return row[-1]
+	raise RuntimeError('the accuracy did not converge to %g' % tol)
+
+def first_spy_accuracy(protocol, degree, spreading_time, tol = 1e-9):
+	''' First-spy accuracy of a sweep cell, as a float '''
+	if protocol == 'gossip':
+		return float(gossip_first_spy_accuracy(degree, spreading_time, tol = tol))
+	return diffusion_first_spy_accuracy(degree, spreading_time, tol)
@@ -0,0 +1,102 @@
+# benchmark.py
+
+from graph_rep import *
+from estimators import *
+from runner import seed_trial
+from utils import *
+import json
+import multiprocessing
+import resource
+import timeit
+
+
+def spread(protocol, degree, spreading_time):
+	if protocol == 'gossip':
+		G = RegularTreeGossip(degree, spreading_time)
+	else:
+		G = RegularTreeDiffusion(degree, spreading_time)
+	G.spread_message()
+	return G
+
+# name: (protocol, setup, timed operation). setup builds the object that the
+# timed operation runs on, from (degree, spreading_time).
+BENCHMARKS = {
+	'diffusion-spread': ('diffusion', lambda d, t: RegularTreeDiffusion(d, t), lambda G: G.spread_message()),
+	'diffusion-events': ('diffusion', lambda d, t: RegularTreeDiffusionEvents(d, spreading_time = t), lambda G: G.spread_message()),
+	'gossip-spread': ('gossip', lambda d, t: RegularTreeGossip(d, t), lambda G: G.spread_message()),
+	'first-spy': ('gossip', lambda d, t: FirstSpyEstimator(spread('gossip', d, t)), lambda est: est.estimate_source()),
+	'first-spy-diffusion': ('diffusion', lambda d, t: FirstSpyDiffusionEstimator(spread('diffusion', d, t)), lambda est: est.estimate_source()),
+	'ml': ('gossip', lambda d, t: MLEstimator(spread('gossip', d, t)), lambda est: est.estimate_source()),
+	'ml-mp': ('gossip', lambda d, t: MLEstimatorMP(spread('gossip', d, t)), lambda est: est.estimate_source()),
+	'ml-mp-log': ('gossip', lambda d, t: MLEstimatorMP(spread('gossip', d, t), log_domain = True), lambda est: est.estimate_source()),
+}
+
+def run_case(case, seed, repeats, queue):
+	''' Runs one benchmark case in its own process, so that the peak resident
+	memory it reports belongs to this case only '''
+	(name, degree, spreading_time) = case
+	(protocol, setup, operation) = BENCHMARKS[name]
+	start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+	times = []
+	nodes = 0
+	for repeat in range(repeats):
+		seed_trial(seed, degree, spreading_time, repeat)
+		item = setup(degree, spreading_time)
+		start = timeit.default_timer()
+		operation(item)
+		times += [timeit.default_timer() - start]
+		# Estimators hold their tree in G
+		nodes += getattr(item, 'G', item).num_nodes
+
+	queue.put({'name': name, 'degree': degree, 'spreading_time': spreading_time,
+			   'repeats': repeats, 'time_min': min(times), 'time_median': float(np.median(times)),
+			   'peak_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss,
+			   'nodes': float(nodes) / repeats})
+
+def run_benchmarks(names, degrees, gossip_times, diffusion_rings, seed, repeats):
+	results = []
+	for name in names:
+		spreading_times = gossip_times if BENCHMARKS[name][0] == 'gossip' else diffusion_rings
+		for degree in degrees:
+			for spreading_time in spreading_times:
+				queue = multiprocessing.Queue()
+				process = multiprocessing.Process(target = run_case,
+												  args = ((name, degree, spreading_time), seed, repeats, queue))
+				process.start()
+				result = queue.get()
+				process.join()
+				print '%-20s d=%-3d T=%-3d %10.5f s %10d kB %12.1f nodes' % (name, degree, spreading_time,
+					result['time_median'], result['peak_kb'], result['nodes'])
+				results += [result]
+	return results
+
+def compare(results, baseline, threshold):
+	''' Prints the ratio of each median time and peak memory to the baseline,
+	marking the cases that got slower than threshold times the baseline '''
+	key = lambda result: (result['name'], result['degree'], result['spreading_time'])
+	reference = dict((key(result), result) for result in baseline['results'])
+	print '\n---Comparison with baseline---'
+	for result in results:
+		if key(result) not in reference:
+			continue
+		old = reference[key(result)]
+		time_ratio = result['time_median'] / max(old['time_median'], 1e-9)
+		memory_ratio = float(result['peak_kb']) / max(old['peak_kb'], 1)
+		flag = 'REGRESSION' if time_ratio > threshold else ''
+		print '%-20s d=%-3d T=%-3d time x%6.2f  memory x%6.2f  %s' % (result['name'], result['degree'],
+			result['spreading_time'], time_ratio, memory_ratio, flag)
+
+
+if __name__ == "__main__":
+
+	args = parse_benchmark_arguments()
+
+	results = run_benchmarks(args.benchmarks, args.degrees, args.gossip_times, args.diffusion_rings,
+							 args.seed, args.repeats)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({'seed': args.seed, 'repeats': args.repeats, 'results': results}, f, indent = 1, sort_keys = True)
+	if args.baseline:
+		with open(args.baseline) as f:
+			compare(results, json.load(f), args.threshold)
@@ -0,0 +1,267 @@
+# csr_graph.py
+
+import heapq
+import numpy as np
+from observation import Observation
+import os
+from sortedcontainers import SortedDict
+
+
+class CSRGraph(object):
+	''' Undirected graph in compressed sparse row form: the neighbors of node
+	u are indices[indptr[u]:indptr[u + 1]]. Nodes are 0..num_nodes-1; labels
+	maps them back to the ids of the edge list they were read from. The arrays
+	are only read, so they can be memory-mapped and shared by many processes. '''
+
+	def __init__(self, indptr, indices, labels = None):
+		self.indptr = indptr
+		self.indices = indices
+		self.labels = labels
+		self.num_nodes = len(indptr) - 1
+
+	@classmethod
+	def from_edges(cls, edges, num_nodes = None, labels = None):
+		''' Builds the graph from an (edges x 2) array of node numbers, dropping
+		self-loops and repeated edges '''
+		edges = np.asarray(edges, dtype = np.int64).reshape(-1, 2)
+		if num_nodes is None:
+			num_nodes = int(edges.max()) + 1 if len(edges) else 0
+		edges = edges[edges[:, 0] != edges[:, 1]]
+		edges = np.sort(edges, axis = 1)
+		edges = edges[np.unique(edges[:, 0] * num_nodes + edges[:, 1], return_index = True)[1]]
+
+		tails = np.concatenate([edges[:, 0], edges[:, 1]])
+		heads = np.concatenate([edges[:, 1], edges[:, 0]])
+		order = np.argsort(tails, kind = 'mergesort')
+		indptr = np.zeros(num_nodes + 1, dtype = np.int64)
+		indptr[1:] = np.cumsum(np.bincount(tails, minlength = num_nodes))
+		return cls(indptr, heads[order], labels)
+
+	@classmethod
+	def from_edge_list(cls, filename):
+		''' Reads a whitespace-separated edge list (one "u v" pair per line, '#'
+		comments allowed). Node ids need not be contiguous. '''
+		pairs = np.loadtxt(filename, dtype = np.int64, comments = '#', ndmin = 2)[:, :2]
+		(labels, edges) = np.unique(pairs, return_inverse = True)
+		return cls.from_edges(edges.reshape(-1, 2), len(labels), labels)
+
+	def save(self, directory):
+		''' Writes the arrays as .npy files, which load can memory-map '''
+		if not os.path.exists(directory):
+			os.makedirs(directory)
+		np.save(os.path.join(directory, 'indptr.npy'), self.indptr)
+		np.save(os.path.join(directory, 'indices.npy'), self.indices)
+		if self.labels is not None:
+			np.save(os.path.join(directory, 'labels.npy'), self.labels)
+
+	@classmethod
+	def load(cls, directory, mmap = True):
+		''' Reads a graph written by save. With mmap, the arrays stay on disk
+		and processes that load the same directory share their pages. '''
+		mode = 'r' if mmap else None
+		labels = None
+		if os.path.exists(os.path.join(directory, 'labels.npy')):
+			labels = np.load(os.path.join(directory, 'labels.npy'), mmap_mode = mode)
+		return cls(np.load(os.path.join(directory, 'indptr.npy'), mmap_mode = mode),
+				   np.load(os.path.join(directory, 'indices.npy'), mmap_mode = mode), labels)
+
+	def degree(self, node):
+		return int(self.indptr[node + 1] - self.indptr[node])
+
+	def neighbors(self, node):
+		return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+	def number_of_nodes(self):
+		return self.num_nodes
+
+	def number_of_edges(self):
+		return len(self.indices) // 2
+
+	def hop_distances(self, source, radius):
+		''' Hop distance from source of every node within radius hops (-1 for
+		the others), found one BFS level at a time '''
+		distance = np.full(self.num_nodes, -1, dtype = np.int32)
+		distance[source] = 0
+		frontier = np.array([source])
+		for hops in range(1, radius + 1):
+			# Neighbors of the whole frontier at once
+			starts = self.indptr[frontier]
+			counts = self.indptr[frontier + 1] - starts
+			offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+			reached = np.unique(self.indices[np.repeat(starts, counts) + offsets])
+			frontier = reached[distance[reached] < 0]
+			if not len(frontier):
+				break
+			distance[frontier] = hops
+		return distance
+
+
+def random_regular_graph(num_nodes, degree, max_rounds = 1000):
+	''' Random degree-regular simple graph from the configuration model: the
+	stubs are paired at random, and the stubs of self-loops and repeated edges
+	are paired again together with as many random other edges, until none are
+	left '''
+	if (num_nodes * degree) % 2:
+		raise ValueError('num_nodes * degree must be even')
+	stubs = np.repeat(np.arange(num_nodes, dtype = np.int64), degree)
+	np.random.shuffle(stubs)
+	edges = stubs.reshape(-1, 2)
+
+	for _ in range(max_rounds):
+		ordered = np.sort(edges, axis = 1)
+		bad = (ordered[:, 0] == ordered[:, 1])
+		(keys, first) = np.unique(ordered[:, 0] * num_nodes + ordered[:, 1], return_index = True)
+		repeated = np.ones(len(edges), dtype = bool)
+		repeated[first] = False
+		bad |= repeated
+		if not bad.any():
+			return CSRGraph.from_edges(edges, num_nodes)
+
+		good = np.flatnonzero(~bad)
+		redo = np.concatenate([np.flatnonzero(bad),
+							   np.random.choice(good, min(len(good), bad.sum()), replace = False)])
+		stubs = edges[redo].ravel()
+		np.random.shuffle(stubs)
+		edges[redo] = stubs.reshape(-1, 2)
+	raise RuntimeError('could not pair the stubs into a simple graph')
+
+
+class CSRDiffusion(object):
+	''' Diffusion over a CSRGraph: every node relays the message to each of its
+	neighbors, and reports it to the adversary, after independent exponential
+	delays. As with RegularTreeDiffusion's rings, the nodes less than
+	spreading_time hops from the source report to the adversary, and receive
+	times are first-passage times within that ball. With first_spy_only, the
+	spreading stops as soon as no later node can report before the earliest
+	adversary timestamp so far. '''
+
+	def __init__(self, graph, spreading_time, source = None, first_spy_only = False):
+		self.graph = graph
+		self.spreading_time = spreading_time
+		self.source = np.random.randint(graph.num_nodes) if (source is None) else source
+		self.first_spy_only = first_spy_only
+		self.lambda1 = 1 # spreading rate over the diffusion graph
+		self.lambda2 = 1 # spreading rate from a node to the adversary
+		self.received_timestamps = np.full(graph.num_nodes, np.nan)
+		self.adversary_timestamps = np.full(graph.num_nodes, np.inf)
+		self.observation = None # set by spread_message
+
+	def spread_message(self):
+		in_ball = self.graph.hop_distances(self.source, self.spreading_time - 1) >= 0
+		done = np.zeros(self.graph.num_nodes, dtype = bool)
+		min_timestamp = np.inf
+
+		# Dijkstra over the ball, with the delays of a node's links drawn
+		# when it receives the message
+		heap = [(0.0, self.source)]
+		while heap:
+			(t, node) = heapq.heappop(heap)
+			if done[node]:
+				continue
+			if self.first_spy_only and (t >= min_timestamp):
+				break
+			done[node] = True
+			self.received_timestamps[node] = t
+			self.adversary_timestamps[node] = t + np.random.exponential(self.lambda2)
+			min_timestamp = min(min_timestamp, self.adversary_timestamps[node])
+
+			neighbors = self.graph.neighbors(node)
+			neighbors = neighbors[in_ball[neighbors] & ~done[neighbors]]
+			arrivals = t + np.random.exponential(self.lambda1, len(neighbors))
+			for (arrival, neighbor) in zip(arrivals.tolist(), neighbors.tolist()):
+				heapq.heappush(heap, (arrival, neighbor))
+
+		self.observation = Observation(self, self.adversary_timestamps, np.isfinite(self.adversary_timestamps))
+
+	def first_spy(self):
+		''' Node with the earliest adversary timestamp '''
+		return int(np.argmin(self.adversary_timestamps))
+
+
+class CSRGossip(object):
+	''' Gossip over a CSRGraph, with the relay rule of RegularTreeGossip: in
+	every round after the one it was infected in, a node passes the message to
+	one of its neighbors that were still uninfected at the start of the round
+	(the adversary included, until it reports), chosen uniformly. Taking the
+	first such neighbor of a uniformly random order of them all, drawn when
+	the node is infected, makes that choice. On a tree no neighbor is ever
+	skipped, as in RegularTreeGossip; on graphs with cycles, neighbors
+	infected through another path are. A neighbor is infected the first time
+	it is contacted.
+
+	MLEstimator runs on it through ball and distance, hop counts from
+	CSRGraph.hop_distances, with degree_bound (the largest degree) in place of
+	the tree degree. '''
+
+	def __init__(self, graph, spreading_time, source = None):
+		self.graph = graph
+		self.spreading_time = spreading_time
+		self.source = np.random.randint(graph.num_nodes) if (source is None) else source
+		self.adversary = -1
+		self.degree_bound = int(np.diff(graph.indptr).max()) if graph.num_nodes else 0
+		self.infect_time = np.full(graph.num_nodes, -1, dtype = np.int32)
+		self.report_time = np.zeros(graph.num_nodes, dtype = np.int32) # 0 until reported
+		self.adversary_timestamps = SortedDict()
+		self.observation = None # set by spread_message
+		self.distances = (None, None) # last BFS of distance: (node, hop distances)
+
+	def spread_message(self):
+		# Each spreading node's random order of its neighbors (and the
+		# adversary), and how far along it the node is
+		orders = {}
+		position = {}
+
+		def infect(node, sender, t):
+			self.infect_time[node] = t
+			receivers = self.graph.neighbors(node)
+			orders[node] = np.random.permutation(np.append(receivers[receivers != sender], self.adversary)).tolist()
+			position[node] = 0
+
+		infect(self.source, self.adversary, 0)
+		for t in range(1, self.spreading_time + 1):
+			# Every spreader picks its receiver among the neighbors that were
+			# uninfected at the start of the round...
+			contacts = []
+			for node in sorted(orders):
+				order = orders[node]
+				i = position[node]
+				while (i < len(order)) and (order[i] != self.adversary) and (self.infect_time[order[i]] >= 0):
+					i += 1
+				if i == len(order):
+					# Nothing left to contact
+					del orders[node]
+					continue
+				contacts += [(node, order[i])]
+				position[node] = i + 1
+
+			# ...then the contacts of the round take effect
+			for (sender, receiver) in contacts:
+				if receiver == self.adversary:
+					self.report_time[sender] = t
+				elif self.infect_time[receiver] < 0:
+					infect(receiver, sender, t)
+
+		reporters = np.flatnonzero(self.report_time)
+		for t in np.unique(self.report_time[reporters]):
+			self.adversary_timestamps[int(t)] = reporters[self.report_time[reporters] == t].tolist()
+		self.observation = Observation(self, self.report_time, self.report_time > 0)
+
+	def infected_nodes(self):
+		return np.flatnonzero(self.infect_time >= 0)
+
+	def ball(self, node, radius):
+		''' Array of the nodes within radius hops of node '''
+		return np.flatnonzero(self.graph.hop_distances(node, radius) >= 0)
+
+	def distance(self, u, v):
+		''' Hop distance between u and v (v may be an array), from a BFS that
+		stops spreading_time hops from u: farther nodes get spreading_time + 1.
+		No reporting node is farther than spreading_time - 1 hops from the
+		source, so the estimators need no more. The BFS of the last u is kept. '''
+		if self.distances[0] != u:
+			self.distances = (u, self.graph.hop_distances(u, self.spreading_time))
+		dist = self.distances[1][v]
+		dist = np.where(dist < 0, self.spreading_time + 1, dist)
+		if np.ndim(dist) == 0:
+			return int(dist)
+		return dist
@@ -0,0 +1,42 @@
+# curves.py
+
+from runner import *
+from utils import *
+import multiprocessing
+
+
+if __name__ == "__main__":
+
+	args = parse_curve_arguments()
+
+	curves = [(protocol, degree) for protocol in args.protocols for degree in args.degrees]
+	estimators = dict((protocol, [estimator for estimator in args.estimators if estimator in CELL_ESTIMATORS[protocol]])
+					  for protocol in args.protocols)
+	tasks = [(protocol, estimators[protocol], degree, args.max_time, args.seed, start,
+			  min(args.block_size, args.trials - start))
+			 for (protocol, degree) in curves for start in range(0, args.trials, args.block_size)]
+
+	# One spread per trial gives every spreading time up to max_time
+	if args.workers > 1:
+		pool = multiprocessing.Pool(args.workers)
+		blocks = pool.map(run_curve_block, tasks)
+		pool.close()
+		pool.join()
+	else:
+		blocks = map(run_curve_block, tasks)
+
+	num_blocks = len(range(0, args.trials, args.block_size))
+	for (i, (protocol, degree)) in enumerate(curves):
+		curve_blocks = blocks[i * num_blocks:(i + 1) * num_blocks]
+		runtime = sum([block_runtime for (_, block_runtime) in curve_blocks])
+		records = []
+		for estimator in estimators[protocol]:
+			hits = sum([block_hits[estimator] for (block_hits, _) in curve_blocks])
+			print '[%s] degree %d: %s accuracy by spreading time %s' % (
+				protocol, degree, estimator, ' '.join(['%.4f' % accuracy for accuracy in hits / args.trials]))
+			# The points of a curve share its runtime evenly
+			records += [make_record(protocol, estimator, degree, spreading_time, args.trials,
+									hits[spreading_time - 1], runtime / (len(estimators[protocol]) * args.max_time),
+									args.seed)
+						for spreading_time in range(1, args.max_time + 1)]
+		append_results(args.output, records)
@@ -1,11 +1,136 @@
 # estimators.py
-import networkx as nx
+import collections
 import random
 from sortedcontainers import SortedDict
 import itertools
 import math
+import time
 import numpy as np
-
+from profiling import PROFILER
+
+
+
+def count_assignments(own_times, child_weights, width):
+	''' For every time in own_times, counts the ways of giving each child a
+	distinct time at which its row of child_weights is nonzero, such that these
+	times and the own time are all distinct and fit in a window of width slots.
+	Each way is weighted by the product of the children's weights at their
+	times. child_weights is a (children x slots) array indexed by time slot, of
+	dtype object (exact integer counts) or float; the counts are returned in an
+	array of the same shape and dtype as one row.
+
+	Rather than enumerating the product of the feasible sets, this sums over
+	the earliest time in the tuple, and runs a DP over the slots of the window
+	that starts there. A DP state is the set of children (as a bitmask) that
+	already have a time, plus the own time if it is chosen, so the cost no
+	longer grows with the product of the set sizes. '''
+
+	(num_children, num_slots) = child_weights.shape
+	full = (1 << num_children) - 1
+	feasible = np.zeros((num_children + 1, num_slots + width), dtype = bool)
+	feasible[:-1, :num_slots] = (child_weights != 0)
+	feasible[-1, own_times] = True
+	own_set = set(own_times)
+	counts = np.zeros(num_slots, dtype = child_weights.dtype)
+	one = 1 if (counts.dtype == object) else 1.0
+
+	# For every possible earliest time low, the last slot of its window that
+	# each child (and the own time) can use, or less than low if there is none
+	slots = np.flatnonzero(feasible.any(axis = 0))
+	last = np.maximum.accumulate(np.where(feasible, np.arange(num_slots + width), -1), axis = 1)
+	all_deadlines = last[:, slots + width - 1]
+	usable = (all_deadlines >= slots).all(axis = 0).tolist()
+	all_deadlines = all_deadlines.T.tolist()
+	window_ends = np.searchsorted(slots, slots + width).tolist()
+	slots = slots.tolist()
+
+	# Children (as bits) that can take each slot, with their weights
+	columns = child_weights.T.tolist()
+	takers = dict((slot, [(1 << i, weight) for (i, weight) in enumerate(columns[slot]) if weight])
+				  for slot in slots if slot < num_slots)
+
+	num_states = 0
+	for (first, low) in enumerate(slots):
+		if not usable[first]:
+			continue
+		deadlines = all_deadlines[first]
+
+		# Tuples whose earliest time is low: slot low must be used
+		states = {(0, None): one}
+		for slot in slots[first:window_ends[first]]:
+			# After this slot, every child (and the own time) whose deadline it
+			# is must have a time; other states are dropped as they are made
+			required = sum([1 << i for (i, deadline) in enumerate(deadlines[:-1]) if deadline <= slot])
+			own_required = (deadlines[-1] <= slot)
+			own_slot = slot in own_set
+			new_states = {}
+			for ((mask, t), value) in states.iteritems():
+				missing = required & ~mask
+				if (slot != low) and not missing and not (own_required and t is None):
+					# Nothing takes this slot
+					new_states[(mask, t)] = new_states.get((mask, t), 0) + value
+				if not (own_required and t is None):
+					for (bit, weight) in takers[slot]:
+						if not (mask & bit) and not (missing & ~bit):
+							key = (mask | bit, t)
+							new_states[key] = new_states.get(key, 0) + value * weight
+				if own_slot and (t is None) and not missing:
+					key = (mask, slot)
+					new_states[key] = new_states.get(key, 0) + value
+			states = new_states
+			num_states += len(states)
+
+		for ((mask, t), value) in states.iteritems():
+			if (mask == full) and (t is not None):
+				counts[t] += value
+
+	PROFILER.count('dp-states', num_states)
+	return counts
+
+def normalize(counts):
+	''' Scales a float count array to a maximum of 1, and returns it with the
+	log of the factor that was divided out '''
+	peak = counts.max()
+	if peak <= 0:
+		return (counts, 0.0)
+	return (counts / peak, math.log(peak))
+
+
+class MessageCache(object):
+	''' Bounded memo of subtree messages, evicting the least recently used
+	entry once it holds max_entries. Keys must identify the message within one
+	trial (e.g. an edge and the rx times of its far end), so a cache can be
+	shared by the estimators of a trial but not across trials. '''
+
+	def __init__(self, max_entries = 2**16):
+		self.max_entries = max_entries
+		self.entries = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		''' Returns the value stored under key, or None '''
+		value = self.entries.pop(key, None)
+		if value is None:
+			self.misses += 1
+			PROFILER.count('cache-misses')
+			return None
+		self.entries[key] = value # most recently used
+		self.hits += 1
+		PROFILER.count('cache-hits')
+		return value
+
+	def put(self, key, value):
+		self.entries.pop(key, None)
+		self.entries[key] = value
+		if len(self.entries) > self.max_entries:
+			self.entries.popitem(last = False)
+			self.evictions += 1
+
+	def stats(self):
+		return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+				'entries': len(self.entries)}
 
 
 class Estimator(object):
@@ -31,40 +156,198 @@ class FirstSpyDiffusionEstimator(DiffusionEstimator):
 		super(FirstSpyDiffusionEstimator, self).__init__(G, verbose)
 
 	def estimate_source(self):
-		min_timestamp = float('inf')
-		min_node = None
-		for node in self.G.nodes():
-			if node in self.G.adversary_timestamps:
-				if self.G.adversary_timestamps[node] <= min_timestamp:
-					min_timestamp = self.G.adversary_timestamps[node]
-					min_node = node
+		return [self.G.first_spy()]
+
+
+class FirstSpyDiffusionBatchEstimator(DiffusionEstimator):
+	''' First-spy estimator over a RegularTreeDiffusionBatch, one estimate per trial '''
+
+	def __init__(self, G, verbose = False):
+		super(FirstSpyDiffusionBatchEstimator, self).__init__(G, verbose)
+
+	def estimate_source(self):
+		return np.argmin(self.G.adversary_timestamps, axis = 1)
+
+	def compute_accuracy(self, source, candidates):
+		''' Returns the accuracy of every trial '''
+		return (candidates == source).astype(float)
+
+
+def exponential_filter(weights, step, scale):
+	''' For each row of weights, sampled on a grid of the given step, returns
+	the integral over y >= x of exp(-(y - x) / scale) / scale * weights(y), at
+	every grid point x: the likelihood of a value x given that a later value,
+	which exceeds it by an exponential delay of mean scale, has likelihood
+	weights. One backward recursion over the grid. '''
+	filtered = np.empty_like(weights)
+	decay = math.exp(-step / scale)
+	total = np.zeros(weights.shape[0])
+	for i in range(weights.shape[1] - 1, -1, -1):
+		total = total * decay + weights[:, i] * (step / scale)
+		filtered[:, i] = total
+	return filtered
+
+
+class MLDiffusionEstimator(DiffusionEstimator):
+	''' Maximum likelihood source of a RegularTreeDiffusion given all the
+	adversary timestamps. Each node receives the message an exponential delay
+	of mean lambda1 after its parent (in the tree rooted at the candidate
+	source), and reports it an exponential delay of mean lambda2 later; the
+	start time has a flat prior.
+
+	Nodes without a timestamp are censored, i.e. taken not to have reported
+	by the end of the observation, only if it is bounded in time (see
+	time_bounded): the end is then the horizon, or the last timestamp once
+	max_observations are in. Nodes of ring spreading_time and beyond never
+	report, so they add a factor of 1, as does every node without a timestamp
+	in a run that went on until all the others had reported.
+
+	The receive times are discretized on a grid of grid_points values, and the
+	likelihood of every candidate is found at once by sum-product message
+	passing: one pass up the tree and one pass down, a ring at a time, so
+	scoring all the candidates costs O(n * grid_points). Messages are kept
+	scaled to a peak of 1 and stored as logarithms. '''
+
+	def __init__(self, G, verbose = False, grid_points = 256, margin = 8.0):
+		super(MLDiffusionEstimator, self).__init__(G, verbose)
+		self.obs = G.observation
+		self.grid_points = grid_points
+		self.margin = margin # grid extent past the earliest and latest timestamps, in delays
 
-		return [min_node]
+	def estimate_source(self):
+		scores = self.score_nodes()
+		best = scores.max()
+		return [int(node) for node in np.flatnonzero(scores >= best - 1e-9 * max(1.0, abs(best)))]
+
+	def score_nodes(self):
+		''' Log-likelihood of every node being the source (up to a constant) '''
+		n = self.obs.num_nodes
+		parent = self.G.parent[:n]
+		ring = self.G.ring[:n]
+		times = self.obs.timestamps
+		lambda1 = float(self.G.lambda1)
+		lambda2 = float(self.G.lambda2)
+		observed = self.obs.reported
+		num_rings = int(ring.max())
+		# Nodes ring by ring; siblings are numbered contiguously, so they stay
+		# next to each other
+		by_ring = np.argsort(ring, kind = 'mergesort')
+		ring_starts = np.searchsorted(ring[by_ring], np.arange(num_rings + 2))
+
+		if not observed.any():
+			return np.zeros(n)
+		# Every timestamp is seen until the latest one, or until the horizon
+		# of an event-driven diffusion, at end
+		end = times[observed].max()
+		if np.isfinite(self.obs.horizon):
+			end = max(end, self.obs.horizon)
+		# Nodes that could have reported after end
+		censored = ~observed
+		if not self.time_bounded():
+			censored[:] = False
+		elif self.obs.spreading_time is not None:
+			censored &= (ring < self.obs.spreading_time)
+		grid = np.linspace(times[observed].min() - self.margin * max(lambda1, lambda2),
+						   end + self.margin * lambda1, self.grid_points)
+		step = grid[1] - grid[0]
+
+		# Factors of each node's receive time are multiplied as logarithms,
+		# with their zeros counted apart so that one can be divided out later
+		(log_inside, zeros_inside) = (np.zeros((n, self.grid_points)), np.zeros((n, self.grid_points), dtype = int))
+		# A node reports after it receives, and a censored node reports after
+		# end; the other nodes without a timestamp never report
+		late = grid[None, :] > times[observed, None]
+		log_inside[observed] = np.where(late, 0, (grid[None, :] - times[observed, None]) / lambda2 - math.log(lambda2))
+		zeros_inside[observed] = late
+		log_inside[censored] = np.minimum(grid[None, :] - end, 0) / lambda2
+
+		# Up: the likelihood of the timestamps in each subtree given the
+		# receive time of the subtree's parent
+		(log_up, zeros_up) = (np.zeros((n, self.grid_points)), np.zeros((n, self.grid_points), dtype = int))
+		for r in range(num_rings, 0, -1):
+			nodes = by_ring[ring_starts[r]:ring_starts[r + 1]]
+			(log_up[nodes], zeros_up[nodes]) = self.send(log_inside[nodes], zeros_inside[nodes], step, lambda1)
+			family_starts = np.flatnonzero(np.diff(parent[nodes], prepend = -1))
+			families = parent[nodes][family_starts]
+			log_inside[families] += np.add.reduceat(log_up[nodes], family_starts)
+			zeros_inside[families] += np.add.reduceat(zeros_up[nodes], family_starts)
+
+		# Down: each node becomes the root, and its parent the child whose
+		# message is the parent's likelihood without the node's own subtree
+		(log_total, zeros_total) = (log_inside, zeros_inside)
+		for r in range(1, num_rings + 1):
+			nodes = by_ring[ring_starts[r]:ring_starts[r + 1]]
+			(log_down, zeros_down) = self.send(log_total[parent[nodes]] - log_up[nodes],
+											   zeros_total[parent[nodes]] - zeros_up[nodes], step, lambda1)
+			log_total[nodes] += log_down
+			zeros_total[nodes] += zeros_down
+
+		# Integrate over the source's receive time (the start time)
+		log_total[zeros_total > 0] = -np.inf
+		peak = log_total.max(axis = 1)
+		with np.errstate(divide = 'ignore'):
+			return np.log(np.exp(log_total - peak[:, None]).sum(axis = 1) * step) + peak
+
+	def time_bounded(self):
+		''' Whether the observation stopped at a time when nodes could still
+		report: at the horizon, or at the max_observations-th timestamp of a
+		RegularTreeDiffusionEvents '''
+		if np.isfinite(self.obs.horizon):
+			return True
+		max_observations = getattr(self.G, 'max_observations', None)
+		return (max_observations is not None) and (len(self.G.observations) >= max_observations)
+
+	def send(self, log_weights, zeros, step, scale):
+		''' Message to the parent, in the form of log_weights and zeros, of
+		nodes whose receive times have the likelihoods log_weights (zero where
+		zeros is positive) '''
+		log_weights = np.where(zeros > 0, -np.inf, log_weights)
+		peak = log_weights.max(axis = 1)
+		peak[~np.isfinite(peak)] = 0
+		message = exponential_filter(np.exp(log_weights - peak[:, None]), step, scale)
+		empty = (message <= 0)
+		with np.errstate(divide = 'ignore'):
+			log_message = np.where(empty, 0, np.log(message)) + peak[:, None]
+		return (log_message, empty.astype(int))
 
 
 class GossipEstimator(Estimator):
 
 	def __init__(self, G, verbose = False):
 		super(GossipEstimator, self).__init__(G, verbose)
+		self.obs = G.observation # what the adversary saw, shared by the trial's estimators
 
 	def get_starting_set(self, timestamp_dict):
 		# Gets the set of nodes within an appropriate radius of the 
 		# nodes that get the message first
 
-		min_timestamp, candidates_first_spy = self.G.adversary_timestamps.items()[0]
+		min_timestamp = self.obs.min_timestamp
+		candidates_first_spy = self.obs.first_spies
 		candidates = set(candidates_first_spy)
 
-		# Then look in an appropriate radius of the first timestamp...
-		cand_neighborhood = []
-		for candidate in candidates:
-			neighborhood = set([candidate])
-			for i in range(min_timestamp - 1):
-				# print 'neighboring set',set(self.G.get_neighbors(candidates))
-				neighborhood = neighborhood.union(set(self.G.get_neighbors(neighborhood)))
-			cand_neighborhood += [neighborhood]
-		candidates = set.intersection(*cand_neighborhood)
-		if self.G.adversary in candidates:
-			candidates.remove(self.G.adversary)
+		def build():
+			# Look in an appropriate radius of the first timestamp, over tree
+			# edges only (the adversary does not relay messages)...
+			run = self.obs.run
+			nodes = run.ball(candidates_first_spy[0], min_timestamp - 1)
+
+			# ...and keep the nodes that are also within that radius of the others
+			for candidate in candidates_first_spy[1:]:
+				if not len(nodes):
+					break
+				nodes = nodes[run.distance(candidate, nodes) <= min_timestamp - 1]
+			return nodes
+
+		# The ball is found over the whole run once, and shared by its
+		# snapshots with the same first spies: the tree of a snapshot holds
+		# the run's first nodes, and is closed under parents
+		nodes = self.obs.run.cached(('starting_set', min_timestamp, candidates_first_spy), build)
+		if self.obs.run is not self.obs:
+			nodes = nodes[nodes < self.obs.num_nodes]
+		candidates = set(int(node) for node in nodes)
+
+		PROFILER.count('candidates', len(candidates))
+		PROFILER.maximum('max-candidates', len(candidates))
 		return candidates
 
 class FirstSpyEstimator(GossipEstimator):
@@ -76,8 +359,33 @@ class FirstSpyEstimator(GossipEstimator):
 		''' Returns the list of nodes that first delivered the message to 
 		the adversary at the same time'''
 
-		min_timestamp, candidates = self.G.adversary_timestamps.items()[0]
-		return candidates
+		# Empty if nobody reported to the adversary in time
+		return list(self.obs.first_spies)
+
+
+class IncrementalFirstSpyEstimator(Estimator):
+	''' First-spy estimator over the growing snapshots of one run, for either
+	protocol: update gets the nodes that started reporting since the last
+	snapshot, so each snapshot costs only its new reports '''
+
+	def __init__(self, G = None, verbose = False):
+		super(IncrementalFirstSpyEstimator, self).__init__(G, verbose)
+		self.min_timestamp = np.inf
+		self.first_spies = []
+
+	def update(self, nodes, timestamps):
+		if not len(nodes):
+			return
+		timestamps = np.asarray(timestamps)
+		first = timestamps.min()
+		if first < self.min_timestamp:
+			(self.min_timestamp, self.first_spies) = (first, [])
+		if first == self.min_timestamp:
+			self.first_spies += [int(node) for node in np.asarray(nodes)[timestamps == first]]
+
+	def estimate_source(self):
+		# Empty until somebody reports
+		return list(self.first_spies)
 
 
 class MLEstimator(GossipEstimator):
@@ -90,7 +398,7 @@ class MLEstimator(GossipEstimator):
 		the true source'''
 
 		# Make sure there are timestamps
-		if not any(self.G.adversary_timestamps):
+		if not len(self.obs.observed):
 			print 'No timestamps found.'
 			return []
 
@@ -101,7 +409,7 @@ class MLEstimator(GossipEstimator):
 
 		# Find the list of eligible nodes, cut 1
 		# Start with the first-spy estimate...
-		timestamp_dict = self.G.generate_timestamp_dict()
+		timestamp_dict = self.obs.timestamp_dict
 		candidates = self.get_starting_set(timestamp_dict)
 
 		# print 'candidates are', candidates, 'before pruning'
@@ -110,19 +418,12 @@ class MLEstimator(GossipEstimator):
 		# Now check if each of these nodes in the radius is eligible
 
 		final_candidates = [i for i in candidates]
+		# Only the nodes that reported to the adversary constrain the source
+		nodes = np.array([node for node in final_candidates if node in timestamp_dict], dtype = np.int64)
+		timestamps = np.array([timestamp_dict[node] for node in nodes])
 		for candidate in candidates:
-			# print 'candidate', candidate
-			valid = True
-			# print 'candidate', candidate, ' has timestamp', timestamp_dict[candidate]
-			for node in candidates:
-				timestamp = timestamp_dict[node]
-				# print 'node', node
-				# print 'timestamp',timestamp, 'lb', self.min_timestamp(candidate, node), 'ub', self.max_timestamp(candidate, node)
-				if not self.check_node(candidate, node, timestamp):
-					valid = False
-					# print 'FAIL candidate', candidate
-					break
-			if not valid:
+			# Check the timestamps of all the nodes against this candidate at once
+			if not np.all(self.check_node(candidate, nodes, timestamps)):
 				final_candidates.remove(candidate)
 
 		# print 'ml candidates are', final_candidates
@@ -130,31 +431,47 @@ class MLEstimator(GossipEstimator):
 
 
 	def check_node(self, source, target, timestamp):
-		''' Checks if target's timestamp is eligible'''
+		''' Checks if target's timestamp is eligible (target and timestamp may
+		be arrays)'''
 		lowerbound = (timestamp >= self.min_timestamp(source, target))
 		upperbound = (timestamp <= self.max_timestamp(source, target))
-		return (lowerbound and upperbound)
+		return (lowerbound & upperbound)
 
 	def min_timestamp(self, source, target):
-		return (nx.shortest_path_length(self.G, source = source, target = target) + 1)
+		return (self.obs.distance(source, target) + 1)
 
 	def max_timestamp(self, source, target):
-		d = self.G.tree_degree
-		pathlength = nx.shortest_path_length(self.G, source = source, target = target)
-
-		if pathlength == 0:
-			return (d + 1)
+		d = self.obs.degree
+		pathlength = self.obs.distance(source, target)
 		return (d + 1) + (d * pathlength)
 
 
 class MLEstimatorMP(GossipEstimator):
 
-	def __init__(self, G, verbose = False):
+	def __init__(self, G, verbose = False, reroot = False, log_domain = False, cache = None,
+				 branch_and_bound = False):
 		super(MLEstimatorMP, self).__init__(G, verbose)
 		self.timestamp_dict = None
 		self.rx_time = {}
-		self.count_dict = {}
-		self.adversary = self.G.adversary
+		self.count_dict = {} # node -> counts indexed by rx time slot
+		self.log_scale = {} # node -> log of the factor its counts are divided by
+		self.messages = {}
+		self.num_slots = 0
+		# Exact integer counts, or floats scaled into range (scores are then
+		# log-likelihoods)
+		self.log_domain = log_domain
+		# Subtree messages, reused across candidates (and across the estimators
+		# of a trial that are given the same cache)
+		self.cache = MessageCache() if (cache is None) else cache
+		# Evaluate the candidates with the largest count bounds first, and stop
+		# evaluating those that cannot reach the best count
+		self.branch_and_bound = branch_and_bound
+		self.bounds = {}
+		self.best = None
+		self.child_bounds = []
+		self.depth = {} # only kept while profiling
+		self.reroot = reroot # score all candidates from shared edge messages
+		self.adversary = self.obs.adversary
 		
 
 	def estimate_source(self):
@@ -162,16 +479,20 @@ class MLEstimatorMP(GossipEstimator):
 		the true source'''
 
 		# Make sure there are timestamps
-		if not any(self.G.adversary_timestamps):
+		if not len(self.obs.observed):
 			print 'No timestamps found.'
 			return []
 
 
 		# Get the starting set of nodes
-		self.timestamp_dict = self.G.generate_timestamp_dict()
+		# Shared with the other estimators of the trial, so only read
+		self.timestamp_dict = self.obs.timestamp_dict
+		# Every rx time is earlier than the node's own timestamp
+		self.num_slots = max(self.timestamp_dict.values()) + 1
 		# try not updating boundary nodes
 		# ---------------------------------self.update_boundary_nodes()
-		candidates = self.get_starting_set(self.timestamp_dict)
+		with PROFILER.stage('starting-set'):
+			candidates = self.get_starting_set(self.timestamp_dict)
 
 		if self.verbose:
 			# print 'timestamps are ', self.G.adversary_timestamps
@@ -190,46 +511,70 @@ class MLEstimatorMP(GossipEstimator):
 
 		# print 'adjacency', self.G.edges()
 
-
 		# print 'candidates: ', candidates, 'timestamps', self.timestamp_dict, '\n'
-		for candidate in candidates:
-			if self.verbose:
-				print '\nprocessing candidate ', candidate, '\n'
+		if self.reroot:
+			candidates = list(candidates)
+			with PROFILER.stage('reroot'):
+				counts = self.score_candidates_rerooted(candidates)
+		elif self.branch_and_bound:
+			candidates = list(candidates)
+			counts = self.score_candidates_bounded(candidates)
+		else:
+			for candidate in candidates:
+				if self.verbose:
+					print '\nprocessing candidate ', candidate, '\n'
 
-			self.feasible = True
-			# -----Run the message-passing------
-			count = self.pass_down_messages(candidate, candidate)
-			
-			if self.verbose:
-				print 'candidate', candidate, ' has count ', count
-			
-			counts += [count]
+				self.feasible = True
+				# -----Run the message-passing------
+				with PROFILER.stage('pass-down'):
+					count = self.pass_down_messages(candidate, candidate)
+
+				if self.verbose:
+					print 'candidate', candidate, ' has count ', count
+
+				counts += [count]
 
 		if self.verbose:
 			print 'candidates counts are ', zip(candidates, counts)
 
-		final_candidates = [candidate for (candidate, score) in zip(candidates, counts) if score == max(counts)]
+		best = max(counts)
+		if self.log_domain and (best is not None):
+			# Log-likelihoods of equal counts may differ by rounding
+			final_candidates = [candidate for (candidate, score) in zip(candidates, counts)
+								if (score is not None) and (score >= best - 1e-9 * max(1.0, abs(best)))]
+		else:
+			final_candidates = [candidate for (candidate, score) in zip(candidates, counts) if score == best]
 		return final_candidates
 
+	def new_counts(self, rows = None):
+		''' Zero counts indexed by time slot, with one row per child if rows is
+		given: Python integers, or floats in log-domain mode '''
+		shape = self.num_slots if (rows is None) else (rows, self.num_slots)
+		return np.zeros(shape, dtype = float if self.log_domain else object)
+
+	def score(self, count, log_scale):
+		''' A candidate's score: its count, or the log of it in log-domain mode '''
+		if not self.log_domain:
+			return count
+		if count <= 0:
+			return float('-inf')
+		return math.log(count) + log_scale
+
 
 	def update_boundary_nodes(self):
 		''' Make it look like all the nodes at the boundary have timestamp T+1 '''
-		for n in self.G.nodes():
+		self.timestamp_dict = dict(self.timestamp_dict)
+		for n in range(self.obs.num_nodes):
 			# if self.G.node[n]['infected'] and (n not in self.timestamp_dict):
-			# 	self.timestamp_dict[n] = self.G.spreading_time + 1
-			if (not n == self.G.adversary) and (n not in self.timestamp_dict):
-				self.timestamp_dict[n] = self.G.spreading_time + 1
+			# 	self.timestamp_dict[n] = self.obs.spreading_time + 1
+			if (not n == self.adversary) and (n not in self.timestamp_dict):
+				self.timestamp_dict[n] = self.obs.spreading_time + 1
 
 	def get_tree_neighbors(self, node, remove_item = None):
 		''' Get a node's neighbors that are infected and not the adversary, except 
 		    for item remove_item'''
 
-		neighbors = [n for n in self.G.neighbors(node) if 
-						(self.G.node[n]['infected'] == True) and
-						not (n == self.adversary) and
-						not (n == remove_item) and 
-						(n in self.timestamp_dict)]
-		return neighbors
+		return self.obs.tree_neighbors(node, remove_item)
 			
 	def compute_tx_time(self, target, source_flag = False):
 		# Otherwise, create the list of possible rx times for the children of target
@@ -239,9 +584,9 @@ class MLEstimatorMP(GossipEstimator):
 			print 'self.rx_time[', target, '] = ', self.rx_time[target]
 		for t in self.rx_time[target]:
 			if source_flag:
-				tx_time.update([t+i for i in range(1, self.G.tree_degree + 2)])
+				tx_time.update([t+i for i in range(1, self.obs.degree + 2)])
 			else:
-				tx_time.update([t+i for i in range(1, self.G.tree_degree + 1)])
+				tx_time.update([t+i for i in range(1, self.obs.degree + 1)])
 		tx_time = list(tx_time)
 		try:
 			tx_time.remove(self.timestamp_dict[target])
@@ -252,6 +597,11 @@ class MLEstimatorMP(GossipEstimator):
 	def pass_down_messages(self, source, target):
 		''' Pass messages down the tree with the feasible set of timestamps'''
 
+		if PROFILER.enabled:
+			# Depth of target below the candidate
+			self.depth[target] = 0 if (source == target) else self.depth[source] + 1
+			PROFILER.maximum('recursion-depth', self.depth[target])
+
 		# If source = target, then we're at the root
 		if source == target:
 			self.rx_time[source] = [0]
@@ -263,23 +613,22 @@ class MLEstimatorMP(GossipEstimator):
 
 		else:
 			# Make sure that there's an edge between source and target
-			if not self.G.has_edge(source, target):
+			if not self.obs.has_edge(source, target):
+				PROFILER.count('infeasible-exits')
 				return 0		
 
 			# Identify the target's child nodes
 			child_nodes = self.get_tree_neighbors(target, source)
 
 		# Initialize the down messages		
-		self.count_dict[target] = {}
-		for rx_time in self.rx_time[target]:
-			self.count_dict[target][rx_time] = 0
+		self.count_dict[target] = self.new_counts()
+		self.log_scale[target] = 0.0
 		# print 'dict for target ', target, 'looks like dis', self.count_dict[target]
 
 		# If we're at a leaf, stop passing the message
 		if not child_nodes:
 			# Now set the up-messages to unit value
-			for item in self.rx_time[target]:
-				self.count_dict[target][item] = 1 # number of permutations possible (i.e. 1)
+			self.count_dict[target][self.rx_time[target]] = 1 # number of permutations possible (i.e. 1)
 			# print 'at a leaf', target
 			return
 
@@ -296,11 +645,11 @@ class MLEstimatorMP(GossipEstimator):
 			tx_time = [i for i in tx_time_baseline]
 
 			# Prune the possible tx_times based on the observed timestamps at the receiver
-			# print 'child ', child, 'has timestamp', self.timestamp_dict[child], 'and our spreading_time is ', self.G.spreading_time
-			# if (self.timestamp_dict[child] > self.G.tree_degree):
-			# 	tx_time = [i for i in tx_time if (i >= self.timestamp_dict[child] - self.G.tree_degree)]
+			# print 'child ', child, 'has timestamp', self.timestamp_dict[child], 'and our spreading_time is ', self.obs.spreading_time
+			# if (self.timestamp_dict[child] > self.obs.degree):
+			# 	tx_time = [i for i in tx_time if (i >= self.timestamp_dict[child] - self.obs.degree)]
 			# else:
-			tx_time = [i for i in tx_time if (i >= self.timestamp_dict[child] - self.G.tree_degree)
+			tx_time = [i for i in tx_time if (i >= self.timestamp_dict[child] - self.obs.degree)
 					   					 and (i < self.timestamp_dict[child])]
 			# print 'pruned tx_time for child', child, ' is:',tx_time
 
@@ -310,11 +659,18 @@ class MLEstimatorMP(GossipEstimator):
 			
 			# If there are no valid timestamps, then this candidate is not feasible
 			if not tx_time:
+				PROFILER.count('infeasible-exits')
 				return
 
 			# Add the node's feasible rx_times to the list
 			tx_time_list += [tx_time]
-			self.pass_down_messages(target, child)
+			self.pass_down_child(target, child)
+
+			if (source == target) and (self.best is not None) and self.hopeless(child_nodes[:len(tx_time_list)]):
+				# This candidate cannot reach the best count found so far
+				PROFILER.count('pruned-candidates')
+				self.feasible = False
+				return None
 
 
 
@@ -323,44 +679,400 @@ class MLEstimatorMP(GossipEstimator):
 		self.aggregate_messages(target, child_nodes, tx_time_list)
 		# print 'after dict for target ', target, 'is ', self.count_dict[target]
 			
-		# print 'degree', self.G.tree_degree
+		# print 'degree', self.obs.degree
 
 		# if we're at the root, sum up all the elements in the dictionary
 		if (source == target):
-			# print 'counts from neighbors', self.count_dict[source].keys(), self.count_dict[source].values()
-			return sum(self.count_dict[source].values())
-		
-
-	def aggregate_messages(self, node, neighbors, tx_time_list):
-		# Aggregate the messages from the children and pass it up the chain
-		# order of tx_time_list is [child_nodes target]
-		# print 'target', node, 'child_nodes', neighbors, 'tx_time_list', tx_time_list
-		coordinates = neighbors + [node]
-		tx_time_list += [self.rx_time[node]]
-		# print 'tx_time_list', tx_time_list
-		tuple_list = [list(item) for item in list(itertools.product(*tx_time_list)) if len(set(item)) == len(item)]
-		tuple_list = [item for item in tuple_list if ((max(item) - min(item)) <= (self.G.tree_degree+1)) ]
+			return self.score(self.count_dict[source].sum(), self.log_scale[source])
 		
-		# print 'tuple_list', tuple_list
 
+	def score_candidates_bounded(self, candidates):
+		''' Branch and bound version of calling pass_down_messages on every
+		candidate. Candidates are evaluated in decreasing order of an upper
+		bound on their count; those whose bound (refined as the messages of
+		their children come in) falls below the best count found so far get a
+		score of None, as they cannot be among the most likely sources. '''
+
+		self.bounds = {}
+		child_bounds = dict((candidate, self.root_bounds(candidate)) for candidate in candidates)
+		total_bounds = dict((candidate, -1 if (bounds is None) else reduce(lambda x, y: x * y, bounds, 1))
+							for (candidate, bounds) in child_bounds.iteritems())
+
+		scores = {}
+		self.best = None
+		for candidate in sorted(candidates, key = lambda candidate: total_bounds[candidate], reverse = True):
+			if child_bounds[candidate] is None:
+				# A leaf, or a child that cannot be reached in time
+				scores[candidate] = None
+				continue
+			if (self.best is not None) and self.below_best(self.score(total_bounds[candidate], 0.0)):
+				PROFILER.count('pruned-candidates')
+				scores[candidate] = None
+				continue
 
-		# Count the number of paths that use each candidate arrival time at the source
-		for item in tuple_list:
-			# Multiply the counts associated with each coordinate
-			m = [self.count_dict[neighbors[i]][item[i]] for i in range(len(item)-1)]
-			self.count_dict[node][item[-1]] += np.prod(m)
-			# print 'm is ', m
+			self.feasible = True
+			self.child_bounds = child_bounds[candidate]
+			with PROFILER.stage('pass-down'):
+				count = self.pass_down_messages(candidate, candidate)
+			scores[candidate] = count
+			if (count is not None) and ((self.best is None) or (count > self.best)):
+				self.best = count
+
+		self.best = None
+		return [scores[candidate] for candidate in candidates]
+
+	def below_best(self, score):
+		''' Whether a score (or a bound on one) is less than the best count so far '''
+		if self.log_domain:
+			return score < self.best - 1e-9 * max(1.0, abs(self.best))
+		return score < self.best
+
+	def hopeless(self, evaluated):
+		''' Whether the candidate being evaluated can no longer reach the best
+		count, given the exact totals of its children in evaluated and the
+		bounds of the others '''
+		bound = self.score(reduce(lambda x, y: x * y, self.child_bounds[len(evaluated):], 1), 0.0)
+		for child in evaluated:
+			total = self.score(self.count_dict[child].sum(), self.log_scale[child])
+			bound = (bound + total) if self.log_domain else (bound * total)
+		return self.below_best(bound)
+
+	def root_bounds(self, candidate):
+		''' Bounds on the totals of the counts of the candidate's children, in
+		the order pass_down_messages visits them, or None where it returns None
+		(a leaf, or a child without feasible rx times) '''
+		child_nodes = self.get_tree_neighbors(candidate)
+		if not child_nodes:
+			return None
+		self.rx_time[candidate] = [0]
+		tx_time = self.compute_tx_time(candidate, True)
+		bounds = []
+		for child in child_nodes:
+			rx_times = [i for i in tx_time if (i >= self.timestamp_dict[child] - self.obs.degree)
+						and (i < self.timestamp_dict[child])]
+			if not rx_times:
+				return None
+			bounds += [self.count_bound(candidate, child, rx_times)]
+		return bounds
+
+	def count_bound(self, parent, node, rx_times):
+		''' Upper bound on the total of the counts that pass_down_messages leaves
+		at node when it has these rx times. Letting every child take any of its
+		feasible times, not necessarily distinct or in one window, bounds each
+		count by the product of the children's totals, so the bound is the
+		number of rx times times the product of the children's bounds. '''
+		key = (parent, node, frozenset(rx_times))
+		if key in self.bounds:
+			return self.bounds[key]
+
+		bound = len(rx_times)
+		self.rx_time[node] = rx_times
+		tx_time = self.compute_tx_time(node)
+		for child in self.get_tree_neighbors(node, parent):
+			child_rx_times = [i for i in tx_time if (i >= self.timestamp_dict[child] - self.obs.degree)
+							  and (i < self.timestamp_dict[child])]
+			if not child_rx_times:
+				# pass_down_messages leaves zero counts
+				bound = 0
+				break
+			bound *= self.count_bound(node, child, child_rx_times)
+
+		self.bounds[key] = bound
+		return bound
+
+	def pass_down_child(self, parent, child):
+		''' Runs pass_down_messages from parent to child, unless the counts of the
+		child's subtree are cached. They depend only on the edge and the child's
+		feasible rx times, so they are the same for every candidate whose
+		messages reach child through parent with those rx times. '''
+		key = (parent, child, frozenset(self.rx_time[child]), self.log_domain)
+		cached = self.cache.get(key)
+		if cached is None:
+			self.pass_down_messages(parent, child)
+			self.cache.put(key, (self.count_dict[child], self.log_scale[child]))
+		else:
+			(self.count_dict[child], self.log_scale[child]) = cached
 
-			# Sum the logs of the counts
-			# m = [math.log(self.count_dict[neighbors[i]][item[i]]) for i in range(len(item)-1)]
-			# # Instead of multiplying the values, we add the sum
-			# self.count_dict[node][item[-1]] += sum(m)
+	def aggregate_messages(self, node, neighbors, tx_time_list):
+		# Aggregate the messages from the children and pass it up the chain
+		weights = self.new_counts(len(neighbors))
+		for (row, child, times) in zip(weights, neighbors, tx_time_list):
+			row[times] = self.count_dict[child][times]
+		with PROFILER.stage('aggregate'):
+			counts = count_assignments(self.rx_time[node], weights, self.obs.degree + 2)
+		self.count_dict[node][self.rx_time[node]] += counts[self.rx_time[node]]
+		if self.log_domain:
+			(self.count_dict[node], log_scale) = normalize(self.count_dict[node])
+			self.log_scale[node] = log_scale + sum([self.log_scale[child] for child in neighbors])
+
+		if PROFILER.enabled:
+			# Tuples that a full enumeration of the feasible sets would visit,
+			# and how many of them are valid infection orders
+			PROFILER.count('tuples-enumerated', reduce(lambda x, y: x * len(y), tx_time_list, len(self.rx_time[node])))
+			# (the unit-weight count is not part of the estimator's own work,
+			# so its time is left out of the stages)
+			with PROFILER.overhead():
+				unit_weights = np.zeros(weights.shape, dtype = object)
+				for (row, times) in zip(unit_weights, tx_time_list):
+					row[times] = 1
+				kept = count_assignments(self.rx_time[node], unit_weights, self.obs.degree + 2).sum()
+			PROFILER.count('tuples-kept', kept)
 
 		if self.verbose:
 			print 'up-counts for ', node, 'is ', self.count_dict[node]
-			
-
 
+	def score_candidates_rerooted(self, candidates):
+		''' Computes the counts of all candidates at once, equal to the ones
+		pass_down_messages gives each of them. The counts that pass_down_messages
+		leaves at a node depend only on the edge it comes in through and the
+		node's pooled set of feasible rx times, not on the rest of the path from
+		the candidate. So they are tabulated as messages per directed edge of the
+		observed subtree and rx-time set, each computed once (the sweep towards
+		the leaves fills those every root shares), and every candidate only
+		combines the messages of its own neighbors. A set is an interval of rx
+		times, less at most the parent's timestamp, so each edge holds few. '''
+
+		self.messages = {}
+		return [self.root_count(candidate) for candidate in candidates]
+
+	def child_rx_times(self, node, rx_times, children, source_flag = False):
+		''' Pooled feasible rx times of each child of node, given node's own
+		(as tuples), or None if a child has none, as in pass_down_messages '''
+		self.rx_time[node] = list(rx_times)
+		tx_time = self.compute_tx_time(node, source_flag)
+		child_times = []
+		for child in children:
+			timestamp = self.timestamp_dict[child]
+			times = tuple(sorted([i for i in tx_time if (i >= timestamp - self.obs.degree) and (i < timestamp)]))
+			if not times:
+				PROFILER.count('infeasible-exits')
+				return None
+			child_times += [times]
+		return child_times
+
+	def combine_messages(self, node, rx_times, children, child_times):
+		''' Counts of node for its rx times from its children's messages, and
+		their log scale, as aggregate_messages leaves them '''
+		weights = self.new_counts(len(children))
+		log_scale = 0.0
+		for (row, child, times) in zip(weights, children, child_times):
+			(child_message, child_scale) = self.edge_message(node, child, times)
+			row[list(times)] = child_message[list(times)]
+			log_scale += child_scale
+		with PROFILER.stage('aggregate'):
+			counts = count_assignments(list(rx_times), weights, self.obs.degree + 2)
+		message = self.new_counts()
+		message[list(rx_times)] += counts[list(rx_times)]
+		if self.log_domain:
+			(message, message_scale) = normalize(message)
+			log_scale += message_scale
+		return (message, log_scale)
+
+	def edge_message(self, parent, node, rx_times):
+		''' Returns the counts that pass_down_messages leaves at node when it
+		comes from parent and node has these rx times (a sorted tuple): for every
+		rx time of node, the number of ways the subtree of node that excludes
+		parent can be infected, and their log scale '''
+		key = (parent, node, rx_times)
+		if key in self.messages:
+			return self.messages[key]
+
+		children = self.get_tree_neighbors(node, parent)
+		if not children:
+			# A leaf: one way per rx time
+			(message, log_scale) = (self.new_counts(), 0.0)
+			message[list(rx_times)] = 1
+		else:
+			child_times = self.child_rx_times(node, rx_times, children)
+			if child_times is None:
+				(message, log_scale) = (self.new_counts(), 0.0)
+			else:
+				(message, log_scale) = self.combine_messages(node, rx_times, children, child_times)
+		self.messages[key] = (message, log_scale)
+		return (message, log_scale)
+
+	def root_count(self, candidate):
+		''' Combines the messages of the candidate's neighbors into its score '''
+		child_nodes = self.get_tree_neighbors(candidate)
+		# pass_down_messages returns None at a root with no children, and at a
+		# root with a child that cannot be reached in time
+		if not child_nodes:
+			return None
+		child_times = self.child_rx_times(candidate, (0,), child_nodes, True)
+		if child_times is None:
+			return None
+		(message, log_scale) = self.combine_messages(candidate, (0,), child_nodes, child_times)
+		return self.score(message.sum(), log_scale)
+
+
+class MLEstimatorSampled(GossipEstimator):
+	''' ML estimator by sampling, for trials too big to count exactly. The
+	count of a candidate is the number of ways to give every reporting node a
+	single rx time: a node receiving at t sends to its children in distinct
+	rounds t+1, ..., t+d (t+d+1 at the source) other than its own timestamp,
+	and a node that reports at s received in [s-d, s-1]. This follows one rx
+	time per node rather than pooling them as MLEstimatorMP does, so even its
+	exact value can differ from MLEstimatorMP's count.
+
+	The count is estimated by sequential importance sampling. Walking down
+	the tree from the candidate, each child gets one of the rounds left for
+	it, chosen uniformly, and the sample's weight is the product of the
+	numbers of choices; its mean over samples is an unbiased estimate of the
+	count. Samples are drawn in rounds of up to batch per candidate, vectorized
+	over the round, until every candidate has samples of them or time_budget
+	seconds have passed. The budget is checked between candidates, which are
+	taken in a random order, so the estimate can stop at any point; the
+	candidates not sampled by then tie with the best one.
+
+	After estimate_source, estimates maps each sampled candidate to (log of
+	the estimated count, relative standard error of the estimate, samples). '''
+
+	def __init__(self, G, verbose = False, samples = 1000, time_budget = None, batch = 250):
+		super(MLEstimatorSampled, self).__init__(G, verbose)
+		self.samples = samples # per candidate
+		self.time_budget = time_budget # seconds per trial, or None
+		self.batch = batch
+		self.first_round = 16 # samples per candidate in the first round, with a time budget
+		self.timestamp_dict = None
+		self.num_slots = 0
+		self.plans = {}
+		self.feasible = {} # (parent, node) -> mask of feasible rx times of node
+		self.estimates = {}
 
+	def estimate_source(self):
+		''' Returns the candidates with the highest estimated count so far '''
+		if not len(self.obs.observed):
+			print 'No timestamps found.'
+			return []
+		start_time = time.time()
+		self.timestamp_dict = self.obs.timestamp_dict
+		self.num_slots = max(max(self.timestamp_dict.values()), self.obs.degree + 1) + 1
+		with PROFILER.stage('starting-set'):
+			candidates = sorted(self.get_starting_set(self.timestamp_dict))
+		# Sample the candidates in a random order: node ids follow the spread
+		# from the source, so any order by id would favor it when the budget
+		# cuts the rounds short
+		candidates = [candidates[i] for i in np.random.permutation(len(candidates))]
+
+		# Log-weights of the samples so far, by candidate
+		weights = dict((candidate, []) for candidate in candidates)
+		# With a time budget, rounds start small and double up to batch, so
+		# that even the first round over many candidates fits in the budget.
+		# The deadline is checked before every candidate but the first.
+		size = self.batch if (self.time_budget is None) else min(self.batch, self.first_round)
+		drawn = 0
+		stopped = False
+		while (drawn < self.samples) and not stopped:
+			size = min(size, self.samples - drawn)
+			for (i, candidate) in enumerate(candidates):
+				stopped = (drawn or i) and (self.time_budget is not None) and (time.time() - start_time > self.time_budget)
+				if stopped:
+					break
+				with PROFILER.stage('sample'):
+					weights[candidate] += [self.sample(candidate, size)]
+			drawn += size
+			size = min(2 * size, self.batch)
 
+		self.estimates = {}
+		for candidate in candidates:
+			if weights[candidate]:
+				self.estimates[candidate] = self.summarize(np.concatenate(weights[candidate]))
+				PROFILER.count('samples', self.estimates[candidate][2])
+		if self.verbose:
+			print 'estimates (log count, relative standard error, samples): ', self.estimates
+		# Candidates that the budget left unsampled have not lost: they tie
+		# with the best
+		unsampled = [candidate for candidate in candidates if candidate not in self.estimates]
+		PROFILER.count('unsampled', len(unsampled))
+		feasible = [(score, candidate) for (candidate, (score, error, size)) in self.estimates.iteritems()
+					if score > float('-inf')]
+		if not feasible:
+			return sorted(unsampled)
+		best = max(feasible)[0]
+		return sorted([candidate for (score, candidate) in feasible if score >= best - 1e-9 * max(1.0, abs(best))] +
+					  unsampled)
+
+	def summarize(self, log_weights):
+		''' (log of the mean weight, relative standard error of the mean,
+		samples) '''
+		peak = log_weights.max()
+		if peak == float('-inf'):
+			return (peak, float('inf'), len(log_weights))
+		scaled = np.exp(log_weights - peak)
+		mean = scaled.mean()
+		error = scaled.std() / math.sqrt(len(scaled)) / mean
+		return (math.log(mean) + peak, error, len(log_weights))
+
+	def plan(self, candidate):
+		''' The candidate's reporting tree, in the order it is walked: a list of
+		(node, children) pairs, parents before children. Needs num_slots. '''
+		if candidate not in self.plans:
+			parent = {candidate: None}
+			order = [candidate]
+			steps = []
+			for node in order:
+				children = self.get_tree_neighbors(node, parent[node])
+				for child in children:
+					parent[child] = node
+				order += children
+				if children:
+					# The most constrained children choose first, so that
+					# their siblings are less likely to take all their rounds
+					steps += [(node, sorted(children, key = lambda child: self.feasible_rx_times(node, child).sum()))]
+			self.plans[candidate] = steps
+		return self.plans[candidate]
 
+	def get_tree_neighbors(self, node, remove_item = None):
+		return self.obs.tree_neighbors(node, remove_item)
+
+	def feasible_rx_times(self, parent, node):
+		''' Mask of the rx times of node, reached from parent, that fit its
+		timestamp and leave each of its children at least one feasible time of
+		its own (not necessarily distinct from its siblings'). Sampling only
+		among these keeps most samples from dying out deep in the tree. '''
+		key = (parent, node)
+		if key not in self.feasible:
+			d = self.obs.degree
+			slots = np.arange(self.num_slots)
+			timestamp = self.timestamp_dict[node]
+			mask = (slots >= max(1, timestamp - d)) & (slots < timestamp)
+			for child in self.get_tree_neighbors(node, parent):
+				# Rounds t+1, ..., t+d other than the timestamp, for each t
+				child_mask = self.feasible_rx_times(node, child) & (slots != timestamp)
+				# reachable[t + d] counts the feasible child times in t+1, ..., t+d
+				reachable = np.append(np.convolve(child_mask, np.ones(d)), 0)
+				mask &= reachable[d:d + self.num_slots] > 0
+			self.feasible[key] = mask
+		return self.feasible[key]
+
+	def sample(self, candidate, size):
+		''' Log-weights of size samples of the candidate's rx times '''
+		d = self.obs.degree
+		steps = self.plan(candidate)
+		if not steps:
+			# pass_down_messages gives no count to a candidate without
+			# reporting neighbors
+			return np.full(size, float('-inf'))
+
+		slots = np.arange(self.num_slots)
+		rows = np.arange(size)
+		rx_time = {candidate: np.zeros(size, dtype = np.int64)}
+		log_weights = np.zeros(size)
+		for (node, children) in steps:
+			# Rounds in which node can send to its children
+			width = (d + 1) if (node == candidate) else d
+			t = rx_time[node][:, None]
+			free = (slots > t) & (slots <= t + width) & (slots != self.timestamp_dict.get(node, -1))
+			for child in children:
+				timestamp = self.timestamp_dict[child]
+				choices = free & self.feasible_rx_times(node, child)
+				options = choices.sum(axis = 1)
+				with np.errstate(divide = 'ignore'):
+					log_weights += np.log(options)
+				# The k-th free round, for a uniform k (any round if none is left,
+				# as the sample's weight is already zero)
+				k = (np.random.random(size) * options).astype(np.int64)
+				chosen = np.argmax(np.cumsum(choices, axis = 1) > k[:, None], axis = 1)
+				free[rows, chosen] = False
+				rx_time[child] = chosen
+		return log_weights
@@ -0,0 +1,34 @@
+# first_spy_exact.py
+
+from analytic import *
+from runner import *
+from utils import *
+import itertools
+import time
+
+
+if __name__ == "__main__":
+
+	args = parse_analytic_arguments()
+
+	outside = 0
+	for (protocol, degree, spreading_time) in itertools.product(args.protocols, args.degrees, args.spreading_times):
+		start_time = time.time()
+		accuracy = first_spy_accuracy(protocol, degree, spreading_time, args.tol)
+		line = '[%s] degree %d, spreading time %d: first-spy accuracy %.10f (%.1f ms)' % (
+			protocol, degree, spreading_time, accuracy, 1000 * (time.time() - start_time))
+
+		if args.trials > 0:
+			# Cross-check against the simulator, seeded as a sweep cell
+			cell = {'protocol': protocol, 'estimator': 'first-spy', 'degree': degree, 'spreading_time': spreading_time}
+			(hits, _) = run_cell_block((cell, args.seed, 0, args.trials))
+			(center, half_width) = wilson_interval(hits, args.trials)
+			# (with some slack for rounding, when every trial hits)
+			inside = abs(accuracy - center) <= half_width + 1e-9
+			outside += not inside
+			line += ', simulated %.4f (95%% CI %.4f-%.4f)%s' % (
+				hits / args.trials, center - half_width, center + half_width, '' if inside else ' OUTSIDE')
+		print line
+
+	if args.trials > 0:
+		print 'Cells outside their 95% interval: ', outside
@@ -1,30 +1,114 @@
 # graphrep.py
 
+import heapq
 import networkx as nx
 import random
 from sortedcontainers import SortedDict
 import matplotlib.pyplot as plt
 import numpy as np
+from observation import Observation
 
 # Regular tree that spreads messages according to Bitcoin protocol
-class RegularTree(nx.Graph):
+class RegularTree(object):
+	''' Array-backed d-regular tree. Nodes are integers allocated in creation
+	order, and all the children of a node are allocated at once, so they occupy
+	the contiguous block of indices that starts at child_start[node]. '''
+
+	# (name, dtype, fill value) of the per-node arrays
+	node_arrays = [('parent', np.int64, -1),
+				   ('ring', np.int32, 0),
+				   ('child_start', np.int64, -1),
+				   ('infected', np.bool_, False)]
 
 	def __init__(self, degree = None, spreading_time = None):
-		super(RegularTree, self).__init__()
 		self.tree_degree = degree
 		self.source = 0
-		self.max_node = 1 # highest-index node in the list
+		self.num_nodes = 0
+		self.max_node = 0 # highest-index node in the tree
 		self.active = [0] # list of nodes that are not fully surrounded by infected nodes
 		self.spreading_time = spreading_time
 		if self.spreading_time is None:
 			self.spreading_time = (self.tree_degree * 2 + 1)
 
-		RegularTree.add_node(self,self.source, infected = True)
-
-
-	def add_node(self, u, attr_dict = None, **attr):
-		super(RegularTree, self).add_node(u, attr)
-		self.max_node = max(self.nodes())
+		for (name, dtype, fill) in self.node_arrays:
+			setattr(self, name, np.full(0, fill, dtype = dtype))
+		self.reserve(self.tree_degree + 1)
+
+		self.num_nodes = 1
+		self.infected[self.source] = True
+
+	def reserve(self, size):
+		''' Grows the per-node arrays so that they hold at least size nodes '''
+		capacity = len(self.parent)
+		if size <= capacity:
+			return
+		capacity = max(size, 2 * capacity)
+		for (name, dtype, fill) in self.node_arrays:
+			old = getattr(self, name)
+			new = np.full(capacity, fill, dtype = dtype)
+			new[:len(old)] = old
+			setattr(self, name, new)
+
+	@classmethod
+	def from_arrays(cls, degree, spreading_time, arrays):
+		''' Rebuilds a tree that has already spread from its per-node arrays
+		(a dict by name, e.g. read back from a trace), without drawing
+		anything. Missing arrays get their fill value, except child_start,
+		which is found from parent. The arrays are used as they are, so
+		read-only views of a memory-mapped file do. '''
+		G = cls.__new__(cls)
+		G.tree_degree = degree
+		G.spreading_time = spreading_time
+		G.source = 0
+		G.num_nodes = len(arrays['parent'])
+		G.max_node = G.num_nodes - 1
+		G.active = []
+		for (name, dtype, fill) in cls.node_arrays:
+			setattr(G, name, arrays[name] if (name in arrays) else np.full(G.num_nodes, fill, dtype = dtype))
+
+		if 'child_start' not in arrays:
+			# Siblings are contiguous, so the first child of each parent starts
+			# its block
+			children = np.flatnonzero(G.parent >= 0)
+			parents = G.parent[children]
+			first = np.flatnonzero(np.diff(parents, prepend = -1))
+			G.child_start[parents[first]] = children[first]
+		return G
+
+	def num_children(self, node):
+		if node == self.source:
+			return self.tree_degree
+		return self.tree_degree - 1
+
+	def add_children(self, nodes):
+		''' Attaches all the children of each node in nodes, and returns the
+		indices of the new nodes (grouped by parent, in the order of nodes) '''
+		nodes = np.atleast_1d(np.asarray(nodes, dtype = np.int64))
+		counts = np.where(nodes == self.source, self.tree_degree, self.tree_degree - 1)
+		start = self.num_nodes
+		total = int(counts.sum())
+		self.reserve(start + total)
+
+		new_nodes = np.arange(start, start + total)
+		self.child_start[nodes] = start + np.cumsum(counts) - counts
+		self.parent[new_nodes] = np.repeat(nodes, counts)
+		self.ring[new_nodes] = np.repeat(self.ring[nodes] + 1, counts)
+
+		self.num_nodes += total
+		self.max_node = self.num_nodes - 1
+		return new_nodes
+
+	def children(self, node):
+		start = self.child_start[node]
+		if start < 0:
+			return []
+		return range(start, start + self.num_children(node))
+
+	def neighbors(self, node):
+		neighbors = self.children(node)
+		if self.parent[node] >= 0:
+			neighbors = [self.parent[node]] + neighbors
+		return neighbors
 
 	def get_neighbors(self, sources):
 		neighbors = []
@@ -32,97 +116,214 @@ class RegularTree(nx.Graph):
 			neighbors += self.neighbors(source)
 		return list(set(neighbors))
 
-	def subgraph(self, nbunch):
-		H = nx.Graph.subgraph(self, nbunch)
+	def ball(self, node, radius):
+		''' Returns the array of nodes within distance radius of node. Each step
+		only expands the frontier, and never goes back along the edge that a
+		frontier node was reached from. '''
+		ball = [np.array([node])]
+		frontier = np.array([node])
+		reached_from = np.array([-1])
+		for i in range(radius):
+			# Step up to the parents...
+			parents = self.parent[frontier]
+			up = (parents >= 0) & (parents != reached_from)
+
+			# ...and down to the children
+			counts = np.where(frontier == self.source, self.tree_degree, self.tree_degree - 1)
+			counts[self.child_start[frontier] < 0] = 0
+			offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+			children = np.repeat(self.child_start[frontier], counts) + offsets
+			children_from = np.repeat(frontier, counts)
+			down = children != np.repeat(reached_from, counts)
+
+			frontier, reached_from = (np.concatenate((parents[up], children[down])),
+									  np.concatenate((frontier[up], children_from[down])))
+			if not len(frontier):
+				break
+			ball += [frontier]
+		return np.concatenate(ball)
+
+	def degree(self, node):
+		return len(self.neighbors(node))
+
+	def has_edge(self, u, v):
+		return (self.parent[v] == u) or (self.parent[u] == v)
+
+	def nodes(self):
+		return range(self.num_nodes)
+
+	def number_of_nodes(self):
+		return self.num_nodes
+
+	def edges(self):
+		return [(self.parent[v], v) for v in xrange(self.num_nodes) if self.parent[v] >= 0]
+
+	def distance_index(self):
+		''' Returns a TreeDistanceIndex of the current tree, rebuilt only when
+		the tree has grown since the last call '''
+		index = getattr(self, '_distance_index', None)
+		if (index is None) or (index.num_nodes != self.num_nodes):
+			index = TreeDistanceIndex(self.parent[:self.num_nodes], self.ring[:self.num_nodes])
+			self._distance_index = index
+		return index
+
+	def distance(self, u, v):
+		''' Length of the tree path between u and v (either may be an array) '''
+		dist = self.distance_index().distance(u, v)
+		if np.ndim(dist) == 0:
+			return int(dist)
+		return dist
+
+	def to_networkx(self):
+		''' networkx copy of the tree, for plotting and debugging only '''
+		H = nx.Graph()
+		for node in self.nodes():
+			H.add_node(node, infected = bool(self.infected[node]))
+		H.add_edges_from(self.edges())
 		return H
 
-	def add_edges(self, source, node_list):
-		for node in node_list:
-			self.add_node(node, infected = False)
-			self.add_edge(source, node)
-
-	def infect_node(self, source, target):
-		if (target == self.adversary):
-			self.remove_edge(source, target)
-		else:
-			self.node[target]['infected'] = True
-			self.active += [target]
-			
+	def subgraph(self, nbunch):
+		H = self.to_networkx().subgraph(nbunch)
+		return H
 
-		# Check if the source still has active neighbors; if not, remove it from active list
-		uninfected_neighbors = self.get_uninfected_neighbors(source)
-		if not uninfected_neighbors:
-			self.active.remove(source)
 
-	def get_uninfected_neighbors(self, source):
-		neighbors = self.neighbors(source)
-		uninfected_neighbors = [neighbor for neighbor in neighbors if self.node[neighbor]['infected'] == False]
-		return uninfected_neighbors
+class TreeDistanceIndex(object):
+	''' Tree distances in O(log depth), from the ring (depth) of every node and
+	a binary-lifting table of ancestors: ancestors[j][v] is the ancestor 2^j
+	levels above v, or the root. Queries are vectorized over arrays of nodes. '''
+
+	def __init__(self, parent, ring):
+		self.num_nodes = len(parent)
+		self.ring = ring
+		levels = max(1, int(ring.max()).bit_length())
+		self.ancestors = [np.where(parent >= 0, parent, np.arange(self.num_nodes))]
+		for j in range(1, levels):
+			self.ancestors += [self.ancestors[-1][self.ancestors[-1]]]
+
+	def lca(self, u, v):
+		''' Lowest common ancestor of u and v '''
+		u, v = np.broadcast_arrays(np.asarray(u), np.asarray(v))
+		# Make u the deeper node, and lift it to the depth of v
+		swap = self.ring[u] < self.ring[v]
+		u, v = np.where(swap, v, u), np.where(swap, u, v)
+		diff = self.ring[u] - self.ring[v]
+		for (j, ancestor) in enumerate(self.ancestors):
+			u = np.where((diff >> j) & 1, ancestor[u], u)
+		# Lift both to just below their lowest common ancestor
+		for ancestor in reversed(self.ancestors):
+			differ = ancestor[u] != ancestor[v]
+			u = np.where(differ, ancestor[u], u)
+			v = np.where(differ, ancestor[v], v)
+		return np.where(u == v, u, self.ancestors[0][u])
+
+	def distance(self, u, v):
+		return self.ring[u] + self.ring[v] - 2 * self.ring[self.lca(u, v)]
 
 
 class RegularTreeDiffusion(RegularTree):
 
+	node_arrays = RegularTree.node_arrays + [('received_timestamps', np.float64, np.nan),
+											 ('adversary_timestamps', np.float64, np.inf)]
+
 	def __init__(self, degree = None, spreading_time = None):
 		''' NB: Here the spreading_time	is actually the number of rings of the graph to infect'''
 		super(RegularTreeDiffusion, self).__init__(degree, spreading_time)
 		self.lambda1 = 1 # spreading rate over the diffusion graph
 		self.lambda2 = 1 # spreading rate from a node to the adversary
-		self.adversary_timestamps = {}
-		self.received_timestamps = {}
+
+		# Diffusion always grows complete rings, so the final size is known
+		num_nodes = 1 + self.tree_degree * sum([(self.tree_degree - 1) ** i for i in range(self.spreading_time)])
+		self.reserve(num_nodes)
 		self.received_timestamps[self.source] = 0
+		self.observation = None # set by spread_message
+
 
-		
 	def spread_message(self):
-		
+
 		count = 0
+		boundary = np.array([self.source])
 		while count < self.spreading_time:
 			count += 1
-			new_boundary = []
-			# cycle through the active nodes, and spread with an exponential clock
-			for node in self.active:
-				# Check that all the nodes have enough neighbors
-				if self.degree(node) < (self.tree_degree):
-					num_missing = (self.tree_degree) - self.degree(node)
-					new_nodes = range(self.max_node + 1, self.max_node + num_missing + 1)
-					self.add_edges(node, new_nodes)
-				# Add the new nodes to the boundary
-				new_boundary += new_nodes
-
-				# Adversary infection time
-				self.adversary_timestamps[node] = self.send_to_adversary(node) 
-				# Neighbor infection times
-				for new_node in new_nodes:
-					self.received_timestamps[new_node] = self.send_to_neighbor(node)
-			self.active = [i for i in new_boundary]
-
-	def send_to_adversary(self, node):
-		return self.received_timestamps[node] + np.random.exponential(self.lambda2)
-
-	def send_to_neighbor(self, node):
-		return self.received_timestamps[node] + np.random.exponential(self.lambda1)
+			# Give every node on the boundary all of its neighbors
+			new_nodes = self.add_children(boundary)
+
+			# Adversary infection time
+			self.adversary_timestamps[boundary] = self.send_to_adversary(boundary)
+			# Neighbor infection times
+			self.received_timestamps[new_nodes] = self.send_to_neighbor(self.parent[new_nodes])
+			boundary = new_nodes
+
+		self.record_observation()
+
+	@classmethod
+	def from_arrays(cls, degree, spreading_time, arrays, horizon = np.inf, run = None):
+		G = super(RegularTreeDiffusion, cls).from_arrays(degree, spreading_time, arrays)
+		G.lambda1 = 1
+		G.lambda2 = 1
+		G.record_observation(horizon, run)
+		return G
+
+	def record_observation(self, horizon = np.inf, run = None):
+		''' Builds the trial's Observation, which ends at horizon if it does
+		not end with the last timestamp (run: see Observation) '''
+		times = self.adversary_timestamps[:self.num_nodes]
+		self.observation = Observation(self, times, np.isfinite(times), horizon, run)
+
+	def snapshots(self):
+		''' Yields (rings, G, reported) after each ring of a run that has
+		spread: G is the tree as a run with that many rings would have left it
+		(the nodes up to that ring, with the reports of the rings before it),
+		and reported holds the nodes that started reporting since the previous
+		snapshot. Nodes are allocated ring by ring, so each G holds the first
+		nodes of the run. '''
+		# The nodes of ring r are ends[r]..ends[r + 1] - 1
+		ends = np.searchsorted(self.ring[:self.num_nodes], np.arange(-1, self.spreading_time + 1), 'right')
+		for rings in range(1, self.spreading_time + 1):
+			n = ends[rings + 1]
+			times = self.adversary_timestamps[:n].copy()
+			times[ends[rings]:] = np.inf
+			arrays = {'parent': self.parent[:n], 'ring': self.ring[:n], 'infected': self.infected[:n],
+					  'received_timestamps': self.received_timestamps[:n], 'adversary_timestamps': times}
+			G = RegularTreeDiffusion.from_arrays(self.tree_degree, rings, arrays, run = self.observation)
+			(G.source, G.lambda1, G.lambda2) = (self.source, self.lambda1, self.lambda2)
+			yield (rings, G, np.arange(ends[rings - 1], ends[rings]))
+
+	def send_to_adversary(self, nodes):
+		return self.received_timestamps[nodes] + np.random.exponential(self.lambda2, len(nodes))
+
+	def send_to_neighbor(self, nodes):
+		return self.received_timestamps[nodes] + np.random.exponential(self.lambda1, len(nodes))
+
+	def first_spy(self):
+		''' Node with the earliest adversary timestamp (nodes that never
+		reported have an infinite one), or None if no node reported, as can
+		happen to a replayed RegularTreeDiffusionEvents trial '''
+		first = int(np.argmin(self.adversary_timestamps[:self.num_nodes]))
+		if not np.isfinite(self.adversary_timestamps[first]):
+			return None
+		return first
 
 
 
 class RegularTreeGossip(RegularTree):
 
+	node_arrays = RegularTree.node_arrays + [('infect_time', np.int32, -1),
+											 ('report_time', np.int32, 0)]
+
 	def __init__(self, degree = None, spreading_time = None):
 		super(RegularTreeGossip, self).__init__(degree, spreading_time)
 		self.adversary = -1
 		self.adversary_timestamps = SortedDict()
+		self.infect_time[self.source] = 0
+		self.observation = None # set by spread_message
 
-		self.add_node(self.adversary, infected = False)
-		
-
-	def add_edge(self, u, v):
-		super(RegularTree, self).add_edge(u, v)
-		super(RegularTree, self).add_edge(u, self.adversary)
-		super(RegularTree, self).add_edge(v, self.adversary)
-
-	def add_node(self, u, attr_dict = None, **attr):
-		super(RegularTree, self).add_node(u, attr)
-		if not (u == self.adversary):
-			super(RegularTree, self).add_edge(u, self.adversary)
-		self.max_node = max(self.nodes())
+	def has_edge(self, u, v):
+		# Every node is linked to the adversary until it reports to it
+		if v == self.adversary:
+			return self.report_time[u] == 0
+		if u == self.adversary:
+			return self.report_time[v] == 0
+		return super(RegularTreeGossip, self).has_edge(u, v)
 
 	def generate_timestamp_dict(self):
 		''' Creates a dict with nodes as keys and timestamps as values '''
@@ -132,61 +333,290 @@ class RegularTreeGossip(RegularTree):
 				timestamp_dict[node] = key
 		return timestamp_dict
 
+	def to_networkx(self):
+		H = super(RegularTreeGossip, self).to_networkx()
+		H.add_node(self.adversary, infected = False)
+		H.add_edges_from([(node, self.adversary) for node in self.nodes() if self.report_time[node] == 0])
+		return H
+
 	def draw_plot(self):
-		values = ['r' for i in self.nodes()]
-		values[-1] = 'b'
+		H = self.to_networkx()
+		values = ['b' if i == self.adversary else 'r' for i in H.nodes()]
 
-		pos=nx.circular_layout(self) # positions for all nodes
+		pos=nx.circular_layout(H) # positions for all nodes
 
-		nx.draw(self, pos = pos, node_color = values)
+		nx.draw(H, pos = pos, node_color = values)
 
 		labels={}
-		for i in self.nodes():
+		for i in H.nodes():
 			labels[i] = str(i)
-		nx.draw_networkx_labels(self,pos,labels,font_size=16)
+		nx.draw_networkx_labels(H,pos,labels,font_size=16)
 
 		plt.show()
 
 	def spread_message(self):
-		t = 1
-		candidates = []
-		reached_adversary = False
-
-		
-		while (t <= self.spreading_time):
-			current_active = [item for item in self.active]
-			for node in current_active:
-				# Check that all the nodes have enough neighbors
-				if ((self.degree(node) < (self.tree_degree + 1) and self.has_edge(node, self.adversary)) or
-				   (self.degree(node) < (self.tree_degree) and (not self.has_edge(node, self.adversary)))): 
-					if (self.degree(node) < (self.tree_degree + 1) and self.has_edge(node, self.adversary)):
-						num_missing = (self.tree_degree + 1) - self.degree(node)
-					else:
-						num_missing = self.tree_degree - self.degree(node)
-					new_nodes = range(self.max_node + 1, self.max_node + num_missing + 1)
-					self.add_edges(node, new_nodes)
-				
-				# print 'adjacency: ', self.edges()
-
-				# Spread to the active nodes' uninfected neighbors
-				uninfected_neighbors = self.get_uninfected_neighbors(node)
-				# print 'uninfected_neighbors', uninfected_neighbors, 'current_active', current_active, 'node', node
-				to_infect = random.choice(uninfected_neighbors)
-				self.infect_node(node, to_infect)
-				# print 'node ', node, ' infected ', to_infect
-				
-				
-				if to_infect == self.adversary:
-					# self.adversary_timestamps.append([node,t])
-					if (t in self.adversary_timestamps):
-						self.adversary_timestamps[t] += [node]
-					else:
-						self.adversary_timestamps[t] = [node]
-					# self.adversary_timestamps += [t]
-					# candidates += [node]
-					# reached_adversary = True
-			t += 1
-		# print 'timestamps:', self.adversary_timestamps
-
-	
+		''' An active node passes the message to one of its remaining uninfected
+		neighbors (the adversary included) per round, chosen uniformly, so the
+		order in which it reaches them is a uniformly random permutation. Drawing
+		that permutation when the node becomes active gives the rounds of all its
+		transmissions at once, so each round only touches the newly active nodes. '''
+
+		# newly_infected[t] holds the nodes infected in round t
+		newly_infected = [[] for t in range(self.spreading_time + 1)]
+		newly_infected[0] = [np.array([self.source])]
+		active = []
+
+		for t in range(1, self.spreading_time + 1):
+			if not newly_infected[t - 1]:
+				continue
+			# Nodes infected in the previous round start spreading in this one
+			spreaders = np.concatenate(newly_infected[t - 1])
+			children = self.add_children(spreaders)
+			num_children = self.num_children(spreaders[0])
+
+			# Round in which each spreader reaches each of its children (first
+			# num_children columns) and the adversary (last column)
+			tx_time = t + np.argsort(np.random.random((len(spreaders), num_children + 1)), axis = 1)
+
+			child_time = tx_time[:, :-1].ravel()
+			for r in range(t, min(t + num_children, self.spreading_time) + 1):
+				reached = children[child_time == r]
+				if len(reached):
+					self.infected[reached] = True
+					self.infect_time[reached] = r
+					newly_infected[r] += [reached]
+
+			reported = tx_time[:, -1] <= self.spreading_time
+			self.report_time[spreaders[reported]] = tx_time[reported, -1]
+			active += [spreaders[tx_time.max(axis = 1) > self.spreading_time]]
+
+		# Nodes infected in the last round never got to spread
+		active += newly_infected[self.spreading_time]
+		self.active = list(np.concatenate(active)) if active else []
+
+		self.record_observation()
+
+	@classmethod
+	def from_arrays(cls, degree, spreading_time, arrays, run = None):
+		G = super(RegularTreeGossip, cls).from_arrays(degree, spreading_time, arrays)
+		G.adversary = -1
+		G.adversary_timestamps = SortedDict()
+		G.record_observation(run)
+		return G
+
+	def snapshots(self):
+		''' Yields (t, G, reported) after each round t of a run that has spread:
+		G is the tree as a run of spreading time t would have left it, and
+		reported holds the nodes that reported in round t. A node's children
+		are allocated in the round after it is infected, in round order, so each
+		G holds the first nodes of the run, and the rounds up to t draw what a
+		shorter run would. '''
+		n = self.num_nodes
+		# Round in which each node was allocated
+		allocated = np.concatenate([[0], self.infect_time[self.parent[1:n]] + 1])
+		for t in range(1, self.spreading_time + 1):
+			size = np.searchsorted(allocated, t, 'right')
+			infect_time = np.where(self.infect_time[:size] <= t, self.infect_time[:size], -1)
+			report_time = np.where(self.report_time[:size] <= t, self.report_time[:size], 0)
+			arrays = {'parent': self.parent[:size], 'ring': self.ring[:size], 'infected': infect_time >= 0,
+					  'infect_time': infect_time, 'report_time': report_time}
+			G = RegularTreeGossip.from_arrays(self.tree_degree, t, arrays, run = self.observation)
+			G.source = self.source
+			yield (t, G, np.array(self.adversary_timestamps.get(t, []), dtype = np.int64))
+
+	def record_observation(self, run = None):
+		''' Groups the reporting nodes by timestamp, and builds the trial's
+		Observation (run: see Observation) '''
+		reporters = np.flatnonzero(self.report_time[:self.num_nodes])
+		reporters = reporters[np.argsort(self.report_time[reporters], kind = 'mergesort')]
+		timestamps = self.report_time[reporters]
+		for (t, nodes) in zip(np.unique(timestamps), np.split(reporters, np.flatnonzero(np.diff(timestamps)) + 1)):
+			self.adversary_timestamps[int(t)] = [int(node) for node in nodes]
+
+		times = self.report_time[:self.num_nodes]
+		self.observation = Observation(self, times, times > 0, run = run)
+
+
+
+class RegularTreeDiffusionBatch(object):
+	''' Runs many independent RegularTreeDiffusion trials at once. Timestamps are
+	stored as (trials x nodes) arrays, with nodes numbered as in
+	RegularTreeDiffusion. Only the rings that report to the adversary are kept. '''
+
+	def __init__(self, degree, spreading_time, trials):
+		self.tree_degree = degree
+		self.spreading_time = spreading_time # number of rings to infect
+		self.trials = trials
+		self.source = 0
+		self.lambda1 = 1 # spreading rate over the diffusion graph
+		self.lambda2 = 1 # spreading rate from a node to the adversary
+		self.received_timestamps = None
+		self.adversary_timestamps = None
+
+	def spread_message(self):
+		# Receive times of one ring, for every trial
+		ring_times = np.zeros((self.trials, 1))
+		received = [ring_times]
+		for ring in range(1, self.spreading_time):
+			num_children = self.tree_degree if ring == 1 else (self.tree_degree - 1)
+			ring_times = np.repeat(ring_times, num_children, axis = 1)
+			ring_times += np.random.exponential(self.lambda1, ring_times.shape)
+			received += [ring_times]
+		self.received_timestamps = np.hstack(received)
+		self.adversary_timestamps = self.received_timestamps + np.random.exponential(self.lambda2, self.received_timestamps.shape)
+
+
+class RegularTreeDiffusionStream(object):
+	''' Runs one RegularTreeDiffusion trial without storing the tree, keeping
+	only the first spy found so far. Subtrees are grown depth-first in blocks of
+	at most block_size nodes of one ring. A node that received the message
+	after the earliest adversary timestamp so far cannot lead to an earlier one
+	(nor can its descendants), so it is dropped before its timestamps are
+	drawn. At most about block_size * degree * rings receive times are held at
+	once, however many rings there are. Nodes are numbered as in
+	RegularTreeDiffusion. '''
+
+	def __init__(self, degree, spreading_time, block_size = 4096):
+		self.tree_degree = degree
+		self.spreading_time = spreading_time # number of rings to infect
+		self.block_size = block_size
+		self.source = 0
+		self.lambda1 = 1 # spreading rate over the diffusion graph
+		self.lambda2 = 1 # spreading rate from a node to the adversary
+		self.min_timestamp = np.inf # earliest adversary timestamp
+		self.min_node = None # (ring, index within the ring) of the first spy
+		self.nodes_reached = 0 # nodes whose adversary timestamp was drawn
+		self.max_stored = 0 # most receive times held at once
+
+	def ring_size(self, ring):
+		if ring == 0:
+			return 1
+		return self.tree_degree * (self.tree_degree - 1) ** (ring - 1)
+
+	def node_id(self, ring, index):
+		return sum([self.ring_size(r) for r in range(ring)]) + int(index)
+
+	def spread_message(self):
+		# Blocks of (ring, receive times, indices within the ring)
+		stack = [(0, np.zeros(1), np.zeros(1, dtype = np.int64))]
+		stored = 1
+		while stack:
+			(ring, received, index) = stack.pop()
+			stored -= len(received)
+
+			keep = received < self.min_timestamp
+			(received, index) = (received[keep], index[keep])
+			if not len(received):
+				continue
+			self.nodes_reached += len(received)
+
+			# Adversary infection times
+			adversary = self.send_to_adversary(received)
+			first = np.argmin(adversary)
+			if adversary[first] < self.min_timestamp:
+				self.min_timestamp = adversary[first]
+				self.min_node = (ring, index[first])
+			if ring + 1 >= self.spreading_time:
+				continue
+
+			# Neighbor infection times, for the nodes that can still matter.
+			# The blocks are pushed last to first, so they are grown in order.
+			keep = received < self.min_timestamp
+			(received, index) = (received[keep], index[keep])
+			num_children = self.tree_degree if (ring == 0) else (self.tree_degree - 1)
+			if self.ring_size(ring + 1) >= 2**63:
+				# Python integers, as the indices no longer fit in 64 bits
+				index = index.astype(object)
+			parents_per_block = max(1, self.block_size // num_children)
+			for start in reversed(range(0, len(received), parents_per_block)):
+				parents = slice(start, start + parents_per_block)
+				child_received = self.send_to_neighbor(np.repeat(received[parents], num_children))
+				child_index = (index[parents, None] * num_children + np.arange(num_children)).ravel()
+				stack += [(ring + 1, child_received, child_index)]
+				stored += len(child_received)
+			self.max_stored = max(self.max_stored, stored)
+
+	def send_to_adversary(self, received):
+		return received + np.random.exponential(self.lambda2, len(received))
+
+	def send_to_neighbor(self, received):
+		return received + np.random.exponential(self.lambda1, len(received))
+
+	def first_spy(self):
+		''' Node with the earliest adversary timestamp '''
+		return self.node_id(*self.min_node)
+
+
+class RegularTreeDiffusionEvents(RegularTree):
+	''' Continuous-time diffusion over a d-regular tree, simulated one event at
+	a time: a heap holds the pending deliveries to neighbors and reports to the
+	adversary, and the earliest is handled first. A node's children are
+	allocated when the first of them is reached, so the tree only holds the
+	reached nodes and their siblings. The simulation stops at time horizon,
+	after max_observations adversary timestamps, or once nothing is left to
+	deliver. With spreading_time set, as in RegularTreeDiffusion only the
+	nodes in rings below it report the message and pass it on; otherwise the
+	rings are unbounded, and horizon or max_observations must be set. '''
+
+	node_arrays = RegularTreeDiffusion.node_arrays
+
+	def __init__(self, degree, horizon = np.inf, max_observations = None, spreading_time = None):
+		if (spreading_time is None) and (horizon == np.inf) and (max_observations is None):
+			raise ValueError('the diffusion needs a horizon, max_observations or spreading_time to stop')
+		super(RegularTreeDiffusionEvents, self).__init__(degree, spreading_time)
+		self.spreading_time = spreading_time # number of rings to infect, or None
+		self.horizon = horizon
+		self.max_observations = max_observations
+		self.lambda1 = 1 # spreading rate over the diffusion graph
+		self.lambda2 = 1 # spreading rate from a node to the adversary
+		self.time = 0.0 # time of the last event handled
+		self.events = 0 # events handled
+		self.observations = [] # (adversary timestamp, node), in time order
+		self.observation = None # set by spread_message
 
+	def spread_message(self):
+		# Events are (time, node, child): child is the slot of the child that
+		# the message is delivered to, or -1 for the report to the adversary
+		heap = []
+		self.receive(self.source, 0.0, heap)
+		while heap:
+			(t, node, child) = heapq.heappop(heap)
+			if t > self.horizon:
+				break
+			self.time = t
+			self.events += 1
+			if child < 0:
+				self.adversary_timestamps[node] = t
+				self.observations += [(t, node)]
+				if len(self.observations) == self.max_observations:
+					break
+				continue
+			if self.child_start[node] < 0:
+				self.add_children([node])
+			self.receive(self.child_start[node] + child, t, heap)
+
+		times = self.adversary_timestamps[:self.num_nodes]
+		self.observation = Observation(self, times, np.isfinite(times), self.horizon)
+
+	def receive(self, node, t, heap):
+		''' Infects node at time t, and schedules its report and its deliveries
+		to its children. Events past the horizon are never handled, so they are
+		not scheduled. '''
+		self.infected[node] = True
+		self.received_timestamps[node] = t
+		if (self.spreading_time is not None) and (self.ring[node] >= self.spreading_time):
+			return
+		report = t + np.random.exponential(self.lambda2)
+		if report <= self.horizon:
+			heapq.heappush(heap, (report, int(node), -1))
+		deliveries = t + np.random.exponential(self.lambda1, self.num_children(node))
+		for (child, delivery) in enumerate(deliveries.tolist()):
+			if delivery <= self.horizon:
+				heapq.heappush(heap, (delivery, int(node), child))
+
+	def first_spy(self):
+		''' Node with the earliest adversary timestamp, or None if no node
+		reported '''
+		if not self.observations:
+			return None
+		return self.observations[0][1]
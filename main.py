@@ -3,6 +3,8 @@
 from graph_rep import *
 from estimators import *
 from utils import *
+from runner import *
+from profiling import PROFILER
 import time
 
 if __name__ == "__main__":
@@ -20,71 +22,81 @@ if __name__ == "__main__":
 	accuracies_first = []
 	accuracies_first_diff = []
 	accuracies_ml = []
+	accuracies_ml_diff = []
+	trials_used = []
+
+	# Event-driven diffusion trials are simulated one at a time
+	events = (args.horizon is not None) or (args.max_observations is not None)
+	batch = args.batch and not (args.stream or events)
+	config = {'gossip': gossip, 'diffusion': diffusion, 'check_ml': check_ml, 'diffusion_ml': args.diffusion_ml,
+			  'reroot': args.reroot, 'log_domain': args.log_counts,
+			  'branch_and_bound': args.branch_and_bound, 'batch': batch, 'verbose': args.verbose,
+			  'sampled': args.sampled_ml, 'samples': args.ml_samples, 'time_budget': args.ml_time_budget,
+			  'seed': args.seed, 'rings': args.rings, 'stream': args.stream,
+			  'horizon': args.horizon, 'max_observations': args.max_observations,
+			  'profile': args.profile,
+			  'block_size': args.batch_size if batch else 10}
 
 	if args.measure_time:
 		start = time.time()
 		end = start
-	for degree in degrees:
-		print 'On degree ', degree
-		count_first = 0
-		count_first_diff = 0
-		count_ml = 0
-
-		for i in range(args.trials):
-			if (i % 100) == 0:
-				print 'On trial ', i+1, ' out of ', args.trials
-
-			if gossip:
-				# Gossip trials
-				G = RegularTreeGossip(degree,degree+3)
-				G.spread_message()
-				
-				# First spy estimator
-				est_first = FirstSpyEstimator(G)
-				result_first = est_first.estimate_source()
-				acc_first = est_first.compute_accuracy(G.source, result_first)
-				count_first += acc_first
-
-				if check_ml:
-					# ML estimator general
-					est_ml = MLEstimatorMP(G, args.verbose)
-					result_ml = est_ml.estimate_source()
-					acc_ml = est_ml.compute_accuracy(G.source, result_ml)
-					count_ml += acc_ml
-
-			if diffusion:
-				# Diffusion trials
-				G = RegularTreeDiffusion(degree,4)
-				G.spread_message()
-
-				# First spy estimator
-				est_first = FirstSpyDiffusionEstimator(G)
-				result_first = est_first.estimate_source()
-				acc_first = est_first.compute_accuracy(G.source, result_first)
-				count_first_diff += acc_first
-
-
-		accuracies_first += [float(count_first) / args.trials]
-		accuracies_first_diff += [float(count_first_diff) / args.trials]
-		accuracies_ml += [float(count_ml) / args.trials]
+	if args.ci_half_width is None:
+		results = ((degree, counts, dict.fromkeys(counts['runtime'], args.trials))
+				   for (degree, counts) in run_trials(config, degrees, args.trials, args.workers))
+	else:
+		# Stop each estimator once its accuracy is known well enough
+		results = run_adaptive_trials(config, degrees, args.ci_half_width, args.trials, args.workers)
+
+	for (degree, counts, used) in results:
+		print 'Done with degree ', degree
+		runtime = counts['runtime'] # by estimator
+
+		accuracies_first += [float(counts['first']) / max(used['first'], 1)]
+		accuracies_first_diff += [float(counts['first_diff']) / max(used['first_diff'], 1)]
+		accuracies_ml += [float(counts['ml']) / max(used['ml'], 1)]
+		accuracies_ml_diff += [float(counts['ml_diff']) / max(used['ml_diff'], 1)]
+		trials_used += [used]
 
 		print '[Gossip] accuracies, first-spy:', accuracies_first
 		# print 'accuracies, ML line:', accuracies_ml_line
-		print '[Gossip] accuracies, ML:', accuracies_ml
+		print '[Gossip] accuracies, %s:' % ml_name(config), accuracies_ml
 		print '[Diffusion] accuracies, first-spy:', accuracies_first_diff
+		if args.diffusion_ml:
+			print '[Diffusion] accuracies, ML:', accuracies_ml_diff
+		if args.ci_half_width is not None:
+			print 'trials used: ', used
 
 		if args.write:
-			result_types = ['first-spy accuracy', 'ML accuracy', 'first-spy accuracy diffusion']
-			param_types = ['degrees']
-			results = [[accuracies_first], [accuracies_ml], [accuracies_first_diff]]
-			params = [[i for i in degrees]]
-			write_results(result_types, results, param_types, params, args.run)
+			records = []
+			if gossip:
+				records += [make_record('gossip', 'first-spy', degree, degree + 3, used['first'], counts['first'], runtime['first'], args.seed)]
+			if gossip and check_ml:
+				records += [make_record('gossip', ml_name(config), degree, degree + 3, used['ml'], counts['ml'], runtime['ml'], args.seed)]
+			# Event-driven runs have unbounded rings, and their own cells
+			rings = -1 if events else config['rings']
+			if diffusion:
+				records += [make_record('diffusion', 'first-spy', degree, rings, used['first_diff'], counts['first_diff'], runtime['first_diff'], args.seed,
+										args.horizon, args.max_observations)]
+			if diffusion and args.diffusion_ml:
+				records += [make_record('diffusion', 'ml', degree, rings, used['ml_diff'], counts['ml_diff'], runtime['ml_diff'], args.seed,
+										args.horizon, args.max_observations)]
+			append_results(results_filename(args.run), records)
 
 	print 'The first-spy estimator accuracy: ', accuracies_first
-	print 'The ML estimator accuracy: ', accuracies_ml
+	print 'The ML estimator (%s) accuracy: ' % ml_name(config), accuracies_ml
 	print 'The first-spy estimator accuracy, diffusion: ', accuracies_first_diff
+	if args.diffusion_ml:
+		print 'The ML estimator accuracy, diffusion: ', accuracies_ml_diff
 	print 'Tested on degrees', degrees
+	if args.ci_half_width is not None:
+		print 'Trials used: ', trials_used
+		print 'Total trials: ', sum([sum(used.values()) for used in trials_used])
 
 	if args.measure_time:
 		end = time.time()
 		print 'The runtime is ', end-start
+
+	if args.profile:
+		PROFILER.report()
+		if args.profile_output:
+			PROFILER.save(args.profile_output)
@@ -0,0 +1,109 @@
+# observation.py
+
+import numpy as np
+
+
+class Observation(object):
+	''' Frozen record of what the adversary saw in one trial, built once by the
+	spreading code (as G.observation) and shared by every estimator of the
+	trial. timestamps holds each node's adversary timestamp, and reported marks
+	the nodes that have one. Structures derived from them are built the first
+	time an estimator asks for them, then cached. Topology queries (ball,
+	distance, has_edge) go to the graph, which must not change afterwards.
+
+	The observation of a snapshot (a prefix of a longer run, see
+	RegularTree.snapshots) keeps the observation of the whole run as run, so
+	that what holds for every prefix is built once per run. '''
+
+	def __init__(self, graph, timestamps, reported, horizon = np.inf, run = None):
+		self.graph = graph
+		self.run = self if (run is None) else run # observation of the whole run
+		# Tree degree, or the largest degree of a general graph
+		self.degree = getattr(graph, 'tree_degree', getattr(graph, 'degree_bound', None))
+		self.spreading_time = graph.spreading_time
+		self.adversary = getattr(graph, 'adversary', None)
+		self.horizon = horizon # end of the observation, if it is not the last timestamp
+		self.num_nodes = len(timestamps)
+		self.timestamps = read_only(np.array(timestamps))
+		self.reported = read_only(np.array(reported, dtype = bool))
+		self.observed = read_only(np.flatnonzero(reported)) # reporting nodes, in order
+		self.cache = {}
+		self.frozen = True
+
+	def __setattr__(self, name, value):
+		if getattr(self, 'frozen', False):
+			raise AttributeError('an Observation cannot be changed')
+		super(Observation, self).__setattr__(name, value)
+
+	def cached(self, name, build):
+		if name not in self.cache:
+			self.cache[name] = build()
+		return self.cache[name]
+
+	@property
+	def timestamp_dict(self):
+		''' Dict of the reporting nodes' timestamps (shared: do not modify it) '''
+		return self.cached('timestamp_dict',
+						   lambda: dict(zip(self.observed.tolist(), self.timestamps[self.observed].tolist())))
+
+	@property
+	def min_timestamp(self):
+		''' Earliest timestamp, or None if no node reported '''
+		if not len(self.observed):
+			return None
+		return self.cached('min_timestamp', lambda: self.timestamps[self.observed].min().item())
+
+	@property
+	def first_spies(self):
+		''' Tuple of the nodes that reported at the earliest timestamp '''
+		def build():
+			if not len(self.observed):
+				return ()
+			times = self.timestamps[self.observed]
+			return tuple(self.observed[times == times.min()].tolist())
+		return self.cached('first_spies', build)
+
+	def tree_neighbors(self, node, exclude = None):
+		''' Reporting neighbors of node (which need not report itself) in a
+		tree graph, other than exclude: the parent first, then the children in
+		order '''
+		(start, neighbors) = self.cached('tree_neighbors', self.build_tree_neighbors)
+		neighbors = neighbors[start[node]:start[node + 1]].tolist()
+		if exclude is not None:
+			neighbors = [neighbor for neighbor in neighbors if neighbor != exclude]
+		return neighbors
+
+	def build_tree_neighbors(self):
+		''' Compact (CSR) lists of the reporting neighbors of every node: they
+		are neighbors[start[node]:start[node + 1]] '''
+		parent = self.graph.parent[:self.num_nodes]
+		children = np.flatnonzero(parent >= 0)
+		parents = parent[children]
+		# Reporting parents, listed at their children...
+		up = self.reported[parents]
+		# ...and reporting children, listed at their parents
+		down = self.reported[children]
+
+		# The parent comes first
+		owners = np.concatenate([children[up], parents[down]])
+		keys = np.concatenate([np.full(up.sum(), -1, dtype = np.int64), children[down]])
+		neighbors = np.concatenate([parents[up], children[down]])
+		order = np.lexsort((keys, owners))
+		start = np.zeros(self.num_nodes + 1, dtype = np.int64)
+		start[1:] = np.cumsum(np.bincount(owners, minlength = self.num_nodes))
+		return (read_only(start), read_only(neighbors[order]))
+
+	def ball(self, node, radius):
+		return self.graph.ball(node, radius)
+
+	def distance(self, u, v):
+		return self.graph.distance(u, v)
+
+	def has_edge(self, u, v):
+		return self.graph.has_edge(u, v)
+
+
+def read_only(array):
+	array = np.asarray(array)
+	array.flags.writeable = False
+	return array
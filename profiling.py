@@ -0,0 +1,151 @@
+# profiling.py
+
+import json
+import timeit
+
+
+class NullStage(object):
+	''' Stage used while profiling is off: does nothing '''
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		return False
+
+
+class Stage(object):
+
+	def __init__(self, profiler, name):
+		self.profiler = profiler
+		self.name = name
+
+	def __enter__(self):
+		self.start = timeit.default_timer()
+		self.overhead = self.profiler.overhead_time
+		return self
+
+	def __exit__(self, *exc_info):
+		overhead = self.profiler.overhead_time - self.overhead
+		self.profiler.add_time(self.name, timeit.default_timer() - self.start - overhead)
+		return False
+
+
+class Overhead(object):
+	''' Work done only to measure something: it is left out of the stages it
+	runs in, and profiling is off while it runs '''
+
+	def __init__(self, profiler):
+		self.profiler = profiler
+
+	def __enter__(self):
+		self.start = timeit.default_timer()
+		self.profiler.enabled = False
+		return self
+
+	def __exit__(self, *exc_info):
+		self.profiler.enabled = True
+		self.profiler.overhead_time += timeit.default_timer() - self.start
+		return False
+
+
+class Profiler(object):
+	''' Per-stage timers and algorithm counters, grouped by a context such as
+	(degree, protocol, estimator). Stages may be nested, in which case the
+	outer stage's time includes the inner one's. Counters are either summed
+	(count) or keep their largest value (maximum). '''
+
+	def __init__(self):
+		self.enabled = False
+		self.context = ()
+		self.overhead_time = 0.0 # total time spent in overhead blocks
+		self.reset()
+
+	def reset(self):
+		self.timers = {} # (context, stage) -> [total time, calls]
+		self.counters = {} # (context, counter) -> total
+		self.maxima = {} # (context, counter) -> largest value
+
+	def set_context(self, *context):
+		self.context = context
+
+	def stage(self, name):
+		if not self.enabled:
+			return NullStage()
+		return Stage(self, name)
+
+	def overhead(self):
+		''' Context for measuring work that the stages around it must not
+		include; only use it while profiling is on '''
+		return Overhead(self)
+
+	def add_time(self, name, elapsed):
+		timer = self.timers.setdefault((self.context, name), [0.0, 0])
+		timer[0] += elapsed
+		timer[1] += 1
+
+	def count(self, name, value = 1):
+		if self.enabled:
+			key = (self.context, name)
+			self.counters[key] = self.counters.get(key, 0) + value
+
+	def maximum(self, name, value):
+		if self.enabled:
+			key = (self.context, name)
+			self.maxima[key] = max(self.maxima.get(key, value), value)
+
+	def snapshot(self):
+		''' Returns the recorded data (e.g. to send it out of a worker process)
+		and clears it '''
+		data = (self.timers, self.counters, self.maxima)
+		self.reset()
+		return data
+
+	def merge(self, data):
+		(timers, counters, maxima) = data
+		for (key, (elapsed, calls)) in timers.iteritems():
+			timer = self.timers.setdefault(key, [0.0, 0])
+			timer[0] += elapsed
+			timer[1] += calls
+		for (key, value) in counters.iteritems():
+			self.counters[key] = self.counters.get(key, 0) + value
+		for (key, value) in maxima.iteritems():
+			self.maxima[key] = max(self.maxima.get(key, value), value)
+
+	def rows(self):
+		''' One dict per (context, stage or counter), sorted by context. Counter
+		totals are also given per trial when a 'trials' counter exists. '''
+		rows = []
+		for ((context, name), (elapsed, calls)) in self.timers.iteritems():
+			rows += [{'context': list(context), 'kind': 'time', 'name': name,
+					  'total': elapsed, 'calls': calls, 'mean': elapsed / calls}]
+		for ((context, name), value) in self.counters.iteritems():
+			trials = self.counters.get((context, 'trials'), 0)
+			rows += [{'context': list(context), 'kind': 'count', 'name': name,
+					  'total': value, 'per_trial': float(value) / trials if trials else None}]
+		for ((context, name), value) in self.maxima.iteritems():
+			rows += [{'context': list(context), 'kind': 'max', 'name': name, 'total': value}]
+		return sorted(rows, key = lambda row: (row['context'], row['kind'], row['name']))
+
+	def report(self):
+		print '\n---Profile---'
+		print '%-28s %-5s %-20s %14s %10s %14s' % ('context', 'kind', 'name', 'total', 'calls', 'mean/per trial')
+		for row in self.rows():
+			context = '/'.join([str(item) for item in row['context']])
+			if row['kind'] == 'time':
+				print '%-28s %-5s %-20s %13.4fs %10d %13.6fs' % (context, row['kind'], row['name'],
+					row['total'], row['calls'], row['mean'])
+			elif row['kind'] == 'count':
+				per_trial = '' if row['per_trial'] is None else '%14.2f' % row['per_trial']
+				print '%-28s %-5s %-20s %14d %10s %14s' % (context, row['kind'], row['name'],
+					row['total'], '', per_trial)
+			else:
+				print '%-28s %-5s %-20s %14d' % (context, row['kind'], row['name'], row['total'])
+
+	def save(self, filename):
+		with open(filename, 'w') as f:
+			json.dump(self.rows(), f, indent = 1)
+
+
+# Process-wide profiler used by the spreading, estimation and trial code
+PROFILER = Profiler()
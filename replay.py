@@ -0,0 +1,53 @@
+# replay.py
+
+from runner import *
+from utils import *
+import multiprocessing
+import time
+
+
+if __name__ == "__main__":
+
+	args = parse_replay_arguments()
+
+	# Simulate once...
+	if args.record:
+		start_time = time.time()
+		live = record_trace(args.trace, args.protocol, args.degrees, args.spreading_time, args.trials, args.seed,
+							args.horizon, args.estimators if args.check else ())
+		print 'Recorded in ', time.time() - start_time, 's'
+		if args.check:
+			# Every estimator must give the same estimates after the round trip
+			mismatches = check_trace(args.trace, live)
+			print 'Round trip: ', len(mismatches), ' estimates differ out of ', len(live) * len(args.estimators)
+			for (trial, estimator) in mismatches[:10]:
+				print '  trial ', trial, ': ', estimator
+	reader = shared_trace(args.trace)
+	print 'Trials: ', len(reader), ' protocol: ', reader.protocol
+
+	# ...and evaluate every estimator on the same stored trials
+	pool = None
+	if args.workers > 1:
+		pool = multiprocessing.Pool(args.workers)
+	for estimator in args.estimators:
+		tasks = [(args.trace, estimator, start, min(args.block_size, len(reader) - start))
+				 for start in range(0, len(reader), args.block_size)]
+		start_time = time.time()
+		blocks = pool.map(run_trace_block, tasks) if (pool is not None) else map(run_trace_block, tasks)
+
+		sums = {}
+		for block in blocks:
+			for (degree, (hits, trials)) in block.iteritems():
+				total = sums.setdefault(degree, [0.0, 0])
+				total[0] += hits
+				total[1] += trials
+		for degree in sorted(sums):
+			(hits, trials) = sums[degree]
+			(center, half_width) = wilson_interval(hits, trials)
+			print '[%s] degree %d: %s accuracy %.4f (95%% CI %.4f-%.4f) over %d trials' % (
+				reader.protocol, degree, estimator, hits / trials, center - half_width, center + half_width, trials)
+		print 'Replayed in ', time.time() - start_time, 's'
+
+	if pool is not None:
+		pool.close()
+		pool.join()
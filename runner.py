@@ -0,0 +1,452 @@
+# runner.py
+
+from graph_rep import *
+from csr_graph import *
+from traces import *
+from estimators import *
+from profiling import PROFILER
+from utils import wilson_interval
+import itertools
+import multiprocessing
+import time
+
+
+def seed_trial(*key):
+	''' Seeds both random number generators from key, so that every trial (or
+	batch) draws from its own stream no matter which process runs it '''
+	np.random.seed([int(k) for k in key])
+	random.seed(np.random.randint(2**31))
+
+def enabled_estimators(config):
+	''' Keys of the accuracy sums that config asks for '''
+	keys = []
+	if config['gossip']:
+		keys += ['first']
+		if config['check_ml']:
+			keys += ['ml']
+	if config['diffusion']:
+		keys += ['first_diff']
+		if config.get('diffusion_ml'):
+			keys += ['ml_diff']
+	return keys
+
+def ml_name(config):
+	''' Name of the ML estimator that config selects, as in CELL_ESTIMATORS '''
+	if config.get('sampled'):
+		return 'ml-sampled'
+	return 'ml' + ('-reroot' if config['reroot'] else '') + ('-log' if config.get('log_domain') else '')
+
+def run_block(task):
+	''' Runs count trials of one degree, starting at trial number start, and
+	returns the sums of their accuracies. Only the estimators listed in
+	config['estimators'] (all enabled ones by default) are run. The time each
+	estimator took, including the spreading of its trials as in a sweep cell,
+	is returned under 'runtime'. With config['profile'], the stage timers and
+	counters of the block are returned under 'profile'. '''
+	(config, degree, start, count) = task
+	counts = {'first': 0.0, 'ml': 0.0, 'first_diff': 0.0, 'ml_diff': 0.0}
+	runtimes = dict.fromkeys(counts, 0.0)
+	active = config.get('estimators', enabled_estimators(config))
+	gossip = ('first' in active) or ('ml' in active)
+	diffusion = 'first_diff' in active
+	# The ML estimator needs the whole tree of each trial, even in batch mode
+	diffusion_trials = ('ml_diff' in active) or (diffusion and not config['batch'])
+	PROFILER.enabled = config.get('profile', False)
+
+	if diffusion and config['batch']:
+		# Diffusion trials, all at once
+		batch_start = time.time()
+		seed_trial(config['seed'], degree, start, count)
+		PROFILER.set_context(degree, 'diffusion', '-')
+		PROFILER.count('trials', count)
+		with PROFILER.stage('build'):
+			G = RegularTreeDiffusionBatch(degree, config['rings'], count)
+		with PROFILER.stage('spread'):
+			G.spread_message()
+
+		# First spy estimator
+		PROFILER.set_context(degree, 'diffusion', 'first-spy')
+		with PROFILER.stage('estimate'):
+			est_first = FirstSpyDiffusionBatchEstimator(G)
+			result_first = est_first.estimate_source()
+		counts['first_diff'] += est_first.compute_accuracy(G.source, result_first).sum()
+		runtimes['first_diff'] += time.time() - batch_start
+
+	if gossip or diffusion_trials:
+		for trial in range(start, start + count):
+			if gossip:
+				# Gossip trials
+				spread_start = time.time()
+				seed_trial(config['seed'], degree, trial)
+				PROFILER.set_context(degree, 'gossip', '-')
+				PROFILER.count('trials')
+				with PROFILER.stage('build'):
+					G = RegularTreeGossip(degree, degree + 3)
+				with PROFILER.stage('spread'):
+					G.spread_message()
+				spread_time = time.time() - spread_start
+
+				if 'first' in active:
+					# First spy estimator
+					estimate_start = time.time()
+					PROFILER.set_context(degree, 'gossip', 'first-spy')
+					with PROFILER.stage('estimate'):
+						est_first = FirstSpyEstimator(G)
+						result_first = est_first.estimate_source()
+					counts['first'] += est_first.compute_accuracy(G.source, result_first)
+					runtimes['first'] += spread_time + time.time() - estimate_start
+
+				if 'ml' in active:
+					# ML estimator general
+					estimate_start = time.time()
+					PROFILER.set_context(degree, 'gossip', ml_name(config))
+					PROFILER.count('trials')
+					with PROFILER.stage('estimate'):
+						if config.get('sampled'):
+							est_ml = MLEstimatorSampled(G, config['verbose'], config['samples'], config.get('time_budget'))
+						else:
+							est_ml = MLEstimatorMP(G, config['verbose'], config['reroot'], config.get('log_domain', False),
+												   branch_and_bound = config.get('branch_and_bound', False))
+						result_ml = est_ml.estimate_source()
+					counts['ml'] += est_ml.compute_accuracy(G.source, result_ml)
+					runtimes['ml'] += spread_time + time.time() - estimate_start
+
+			if diffusion_trials:
+				# Diffusion trials, reseeded so that they do not depend on
+				# whether the gossip trial ran
+				spread_start = time.time()
+				seed_trial(config['seed'], degree, trial)
+				PROFILER.set_context(degree, 'diffusion', '-')
+				PROFILER.count('trials')
+				with PROFILER.stage('build'):
+					if (config.get('horizon') is not None) or (config.get('max_observations') is not None):
+						# Event by event, up to the time horizon or observation count
+						horizon = np.inf if (config.get('horizon') is None) else config['horizon']
+						G = RegularTreeDiffusionEvents(degree, horizon, config.get('max_observations'))
+					elif config.get('stream') and not ('ml_diff' in active):
+						G = RegularTreeDiffusionStream(degree, config['rings'])
+					else:
+						G = RegularTreeDiffusion(degree, config['rings'])
+				with PROFILER.stage('spread'):
+					G.spread_message()
+				spread_time = time.time() - spread_start
+
+				if diffusion and not config['batch']:
+					# First spy estimator
+					estimate_start = time.time()
+					PROFILER.set_context(degree, 'diffusion', 'first-spy')
+					with PROFILER.stage('estimate'):
+						est_first = FirstSpyDiffusionEstimator(G)
+						result_first = est_first.estimate_source()
+					counts['first_diff'] += est_first.compute_accuracy(G.source, result_first)
+					runtimes['first_diff'] += spread_time + time.time() - estimate_start
+
+				if 'ml_diff' in active:
+					# ML estimator over all the timestamps
+					estimate_start = time.time()
+					PROFILER.set_context(degree, 'diffusion', 'ml')
+					PROFILER.count('trials')
+					with PROFILER.stage('estimate'):
+						est_ml = MLDiffusionEstimator(G, config['verbose'])
+						result_ml = est_ml.estimate_source()
+					counts['ml_diff'] += est_ml.compute_accuracy(G.source, result_ml)
+					runtimes['ml_diff'] += spread_time + time.time() - estimate_start
+
+	counts['runtime'] = runtimes
+	if PROFILER.enabled:
+		counts['profile'] = PROFILER.snapshot()
+	return counts
+
+def run_trials(config, degrees, trials, workers = 1):
+	''' Yields (degree, sums of the accuracies over all trials) for each degree,
+	in order, with the estimators' runtimes summed under 'runtime'. Trials are split into fixed blocks of config['block_size'] and
+	reduced in order, so the sums do not depend on the number of workers. The
+	profiles of the blocks are merged into PROFILER. '''
+	block_size = config['block_size']
+	tasks = [(config, degree, start, min(block_size, trials - start))
+			 for degree in degrees for start in range(0, trials, block_size)]
+
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap(run_block, tasks)
+	else:
+		results = itertools.imap(run_block, tasks)
+
+	for degree in degrees:
+		counts = {'first': 0.0, 'ml': 0.0, 'first_diff': 0.0, 'ml_diff': 0.0}
+		runtimes = dict.fromkeys(counts, 0.0)
+		for start in range(0, trials, block_size):
+			block_counts = next(results)
+			if 'profile' in block_counts:
+				PROFILER.merge(block_counts['profile'])
+			for key in runtimes:
+				counts[key] += block_counts[key]
+				runtimes[key] += block_counts['runtime'][key]
+		counts['runtime'] = runtimes
+		yield (degree, counts)
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+def run_adaptive_trials(config, degrees, half_width, max_trials, workers = 1, z = 1.96):
+	''' Sequential version of run_trials: each (degree, estimator) cell runs
+	blocks of trials until the Wilson interval of its accuracy has a half-width
+	of at most half_width, or until it has used max_trials. Yields (degree, sums
+	of the accuracies, trials used) for each degree, in order.
+
+	Rounds of up to workers blocks run in parallel, but each cell's stopping
+	rule is checked after every block in trial order and the blocks past its
+	stopping point are dropped, so the results do not depend on the number of
+	workers. Runtimes are summed under 'runtime' as in run_trials, over the
+	blocks each cell kept. '''
+	block_size = config['block_size']
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+	imap = pool.imap if (pool is not None) else itertools.imap
+
+	for degree in degrees:
+		counts = {'first': 0.0, 'ml': 0.0, 'first_diff': 0.0, 'ml_diff': 0.0}
+		used = dict.fromkeys(counts, 0)
+		runtimes = dict.fromkeys(counts, 0.0)
+		active = enabled_estimators(config)
+		start = 0
+		while active and (start < max_trials):
+			block_config = dict(config, estimators = active)
+			starts = range(start, min(start + workers * block_size, max_trials), block_size)
+			tasks = [(block_config, degree, block_start, min(block_size, max_trials - block_start))
+					 for block_start in starts]
+			running = list(active)
+			for (task, block_counts) in itertools.izip(tasks, imap(run_block, tasks)):
+				if 'profile' in block_counts:
+					PROFILER.merge(block_counts['profile'])
+				for key in running:
+					if key not in active:
+						continue
+					counts[key] += block_counts[key]
+					runtimes[key] += block_counts['runtime'][key]
+					used[key] += task[3]
+					if wilson_interval(counts[key], used[key], z)[1] <= half_width:
+						active.remove(key)
+			start = starts[-1] + block_size
+		counts['runtime'] = runtimes
+		yield (degree, counts, used)
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+# Largest number of adversary timestamps a batch of diffusion trials may hold;
+# bigger batches are streamed one trial at a time
+BATCH_TIMESTAMPS = 2**24
+
+# Estimators that a sweep cell can evaluate, for each spreading protocol.
+# The -reroot variants give the same estimates as ml, so their cells differ
+# only in runtime.
+CELL_ESTIMATORS = {
+	'gossip': {
+		'first-spy': lambda G: FirstSpyEstimator(G),
+		'ml': lambda G: MLEstimatorMP(G),
+		'ml-reroot': lambda G: MLEstimatorMP(G, reroot = True),
+		'ml-log': lambda G: MLEstimatorMP(G, log_domain = True),
+		'ml-reroot-log': lambda G: MLEstimatorMP(G, reroot = True, log_domain = True),
+		'ml-sampled': lambda G: MLEstimatorSampled(G),
+	},
+	'diffusion': {
+		'first-spy': lambda G: FirstSpyDiffusionEstimator(G),
+		'ml': lambda G: MLDiffusionEstimator(G),
+	},
+}
+PROTOCOLS = ['gossip', 'diffusion']
+
+def run_cell_block(task):
+	''' Runs count trials of one sweep cell, starting at trial number start, and
+	returns the sum of their accuracies and the time it took. A cell is a dict
+	with the protocol, estimator, degree and spreading_time. Every estimator of
+	a protocol sees the same trials, since the seed does not depend on the
+	estimator. '''
+	(cell, seed, start, count) = task
+	start_time = time.time()
+	protocol_id = PROTOCOLS.index(cell['protocol'])
+	degree = cell['degree']
+	spreading_time = cell['spreading_time']
+
+	reporting_nodes = 1 + degree * sum([(degree - 1) ** i for i in range(spreading_time - 1)])
+	if (cell['protocol'] == 'diffusion') and (cell['estimator'] == 'first-spy') and \
+	   (count * reporting_nodes <= BATCH_TIMESTAMPS):
+		# Diffusion trials, all at once
+		seed_trial(seed, protocol_id, degree, spreading_time, start, count)
+		G = RegularTreeDiffusionBatch(degree, spreading_time, count)
+		G.spread_message()
+		est = FirstSpyDiffusionBatchEstimator(G)
+		return (est.compute_accuracy(G.source, est.estimate_source()).sum(), time.time() - start_time)
+
+	hits = 0.0
+	for trial in range(start, start + count):
+		seed_trial(seed, protocol_id, degree, spreading_time, trial)
+		if cell['protocol'] == 'gossip':
+			G = RegularTreeGossip(degree, spreading_time)
+		elif cell['estimator'] == 'first-spy':
+			# Too many rings to batch: keep only the first spy
+			G = RegularTreeDiffusionStream(degree, spreading_time)
+		else:
+			G = RegularTreeDiffusion(degree, spreading_time)
+		G.spread_message()
+
+		est = CELL_ESTIMATORS[cell['protocol']][cell['estimator']](G)
+		hits += est.compute_accuracy(G.source, est.estimate_source())
+	return (hits, time.time() - start_time)
+
+def run_curve_block(task):
+	''' Runs count trials of protocol with one degree, starting at trial number
+	start, and returns the sums of their accuracies at every spreading time
+	from 1 to max_time, as a dict of arrays by estimator (as in
+	CELL_ESTIMATORS), and the time it took. Each trial spreads once, for
+	max_time, and its snapshots stand for the runs of every shorter spreading
+	time. First-spy is updated from each snapshot's new reports rather than
+	recomputed.
+
+	Trials are seeded as the sweep cell of max_time, so the last point is
+	that cell's exact result for every gossip estimator and for diffusion ML.
+	Diffusion first-spy cells spread through RegularTreeDiffusionBatch or
+	RegularTreeDiffusionStream, which draw differently, so that point only
+	agrees with the cell in distribution. '''
+	(protocol, estimators, degree, max_time, seed, start, count) = task
+	start_time = time.time()
+	protocol_id = PROTOCOLS.index(protocol)
+
+	hits = dict((estimator, np.zeros(max_time)) for estimator in estimators)
+	for trial in range(start, start + count):
+		seed_trial(seed, protocol_id, degree, max_time, trial)
+		if protocol == 'gossip':
+			G = RegularTreeGossip(degree, max_time)
+		else:
+			G = RegularTreeDiffusion(degree, max_time)
+		G.spread_message()
+
+		first_spy = IncrementalFirstSpyEstimator()
+		for (spreading_time, H, reported) in G.snapshots():
+			first_spy.update(reported, H.observation.timestamps[reported])
+			for estimator in estimators:
+				if estimator == 'first-spy':
+					est = first_spy
+				elif not len(H.observation.observed):
+					# Nothing reported yet: no estimate
+					continue
+				else:
+					est = CELL_ESTIMATORS[protocol][estimator](H)
+				hits[estimator][spreading_time - 1] += est.compute_accuracy(G.source, est.estimate_source())
+	return (hits, time.time() - start_time)
+
+# Topologies loaded by this process, by directory
+GRAPHS = {}
+
+def shared_graph(directory):
+	''' Memory-maps a saved CSRGraph once per process. The pages are shared
+	read-only by every process that maps the same files. '''
+	if directory not in GRAPHS:
+		GRAPHS[directory] = CSRGraph.load(directory)
+	return GRAPHS[directory]
+
+# Estimators that run on a CSRGraph topology, for each spreading protocol
+GRAPH_ESTIMATORS = {
+	'gossip': {
+		'first-spy': lambda G: FirstSpyEstimator(G),
+		'ml': lambda G: MLEstimator(G),
+	},
+	'diffusion': {
+		'first-spy': lambda G: FirstSpyDiffusionEstimator(G),
+	},
+}
+
+def run_graph_block(task):
+	''' Runs count trials of protocol on the topology saved in directory,
+	starting at trial number start, and returns the sum of the accuracies of
+	the estimator named estimator (as in GRAPH_ESTIMATORS). Each trial has its
+	own source, chosen uniformly. '''
+	(directory, protocol, estimator, spreading_time, seed, start, count) = task
+	graph = shared_graph(directory)
+	protocol_id = PROTOCOLS.index(protocol)
+
+	hits = 0.0
+	for trial in range(start, start + count):
+		seed_trial(seed, protocol_id, spreading_time, trial)
+		if protocol == 'gossip':
+			G = CSRGossip(graph, spreading_time)
+		else:
+			# Only the first spy is needed
+			G = CSRDiffusion(graph, spreading_time, first_spy_only = True)
+		G.spread_message()
+		est = GRAPH_ESTIMATORS[protocol][estimator](G)
+		hits += est.compute_accuracy(G.source, est.estimate_source())
+	return hits
+
+# Trace files opened by this process, by filename
+TRACES = {}
+
+def shared_trace(filename):
+	''' Memory-maps a trace file once per process '''
+	if filename not in TRACES:
+		TRACES[filename] = TraceReader(filename)
+	return TRACES[filename]
+
+def record_trace(filename, protocol, degrees, spreading_time, trials, seed, horizon = None, estimators = ()):
+	''' Spreads trials of protocol for each degree into a trace file, seeded
+	as run_cell_block seeds the trials of the same cells. spreading_time is
+	the number of rings for diffusion; by default it is degree + 3 rounds
+	for gossip and 4 rings for diffusion. With horizon, diffusion trials are
+	event-driven and stop at that time, so some may have no report.
+
+	Returns, in trace order, the estimates of the estimators named in
+	estimators (as in CELL_ESTIMATORS) on each trial as it was spread, for
+	check_trace. '''
+	protocol_id = PROTOCOLS.index(protocol)
+	live = []
+	with TraceWriter(filename, protocol) as writer:
+		for degree in degrees:
+			cell_time = spreading_time
+			if cell_time is None:
+				cell_time = (degree + 3) if (protocol == 'gossip') else 4
+			for trial in range(trials):
+				seed_trial(seed, protocol_id, degree, cell_time, trial)
+				if protocol == 'gossip':
+					G = RegularTreeGossip(degree, cell_time)
+				elif horizon is not None:
+					G = RegularTreeDiffusionEvents(degree, horizon, spreading_time = cell_time)
+				else:
+					G = RegularTreeDiffusion(degree, cell_time)
+				G.spread_message()
+				writer.add(G)
+				live += [dict((estimator, sorted(CELL_ESTIMATORS[protocol][estimator](G).estimate_source()))
+							  for estimator in estimators)]
+	return live
+
+def check_trace(filename, live):
+	''' Replays a trace file into the estimators of live (as returned by
+	record_trace) and returns the (trial, estimator) pairs whose estimates
+	differ from the ones on the trials as they were spread '''
+	mismatches = []
+	for (trial, (G, estimates)) in enumerate(itertools.izip(TraceReader(filename).trials(), live)):
+		for (estimator, estimate) in sorted(estimates.items()):
+			make_estimator = CELL_ESTIMATORS[trace_protocol(G)][estimator]
+			if sorted(make_estimator(G).estimate_source()) != estimate:
+				mismatches += [(trial, estimator)]
+	return mismatches
+
+def run_trace_block(task):
+	''' Replays count trials of a trace file, starting at trial number start,
+	into the estimator named estimator (as in CELL_ESTIMATORS), and returns a
+	dict of [sum of accuracies, trials] by degree '''
+	(filename, estimator, start, count) = task
+	reader = shared_trace(filename)
+	make_estimator = CELL_ESTIMATORS[reader.protocol][estimator]
+
+	sums = {}
+	for G in reader.trials(start, start + count):
+		est = make_estimator(G)
+		hits = sums.setdefault(G.tree_degree, [0.0, 0])
+		hits[0] += est.compute_accuracy(G.source, est.estimate_source())
+		hits[1] += 1
+	return sums
@@ -0,0 +1,175 @@
+# sweep.py
+
+from runner import *
+from utils import *
+import itertools
+import json
+import multiprocessing
+import os
+
+
+def cell_key(cell):
+	return '%s/%s/%d/%d' % (cell['protocol'], cell['estimator'], cell['degree'], cell['spreading_time'])
+
+def make_grid(degrees, spreading_times, protocols, estimators):
+	''' Returns every (protocol, estimator, degree, spreading_time) cell, keeping
+	only the estimators that apply to each protocol '''
+	cells = []
+	for protocol in protocols:
+		for estimator in estimators:
+			if estimator not in CELL_ESTIMATORS[protocol]:
+				continue
+			for (degree, spreading_time) in itertools.product(degrees, spreading_times):
+				cells += [{'protocol': protocol, 'estimator': estimator,
+						   'degree': degree, 'spreading_time': spreading_time}]
+	return cells
+
+def expected_size(protocol, degree, spreading_time):
+	''' Expected number of infected nodes in one trial '''
+	if protocol == 'diffusion':
+		return 1 + degree * sum([(degree - 1) ** i for i in range(spreading_time)])
+
+	# A gossip node reaches each of its d-1 children (and the adversary) in a
+	# uniformly random round among the d rounds after it is infected.
+	# size[h] is the expected size of the subtree of a node infected h rounds
+	# before the end.
+	size = [1.0]
+	for h in range(1, spreading_time + 1):
+		size += [1 + (degree - 1) * sum([size[h - j] for j in range(1, min(degree, h) + 1)]) / degree]
+	return 1 + degree * sum([size[spreading_time - j] for j in range(1, min(degree + 1, spreading_time) + 1)]) / (degree + 1)
+
+def cell_cost(cell):
+	''' Rough relative cost of one trial of a cell '''
+	size = expected_size(cell['protocol'], cell['degree'], cell['spreading_time'])
+	if cell['estimator'].startswith('ml') and (cell['protocol'] == 'gossip'):
+		# Message passing over the observed subtree, for many candidates
+		return size ** 2
+	if cell['estimator'].startswith('ml'):
+		# One message passing sweep, over a grid of receive times
+		return size
+	if cell['protocol'] == 'diffusion':
+		# Batched
+		return size / 100.0
+	return size
+
+
+class Checkpoint(object):
+	''' Finished trial counts and accuracy sums of every cell, kept in a JSON
+	file that is rewritten (atomically) after every block of trials '''
+
+	def __init__(self, path, seed, block_size):
+		self.path = path
+		self.state = {'seed': seed, 'block_size': block_size, 'cells': {}}
+		if os.path.exists(path):
+			with open(path) as f:
+				self.state = json.load(f)
+
+	def seed(self):
+		return self.state['seed']
+
+	def block_size(self):
+		return self.state['block_size']
+
+	def trials_done(self, cell):
+		return self.state['cells'].get(cell_key(cell), {}).get('trials', 0)
+
+	def add(self, cell, trials, hits, runtime):
+		record = self.state['cells'].setdefault(cell_key(cell), {'trials': 0, 'hits': 0.0, 'runtime': 0.0})
+		record['trials'] += trials
+		record['hits'] += hits
+		record['runtime'] += runtime
+
+	def written(self, cell):
+		''' Trial count, hits and runtime of the cell already written out '''
+		record = self.state['cells'][cell_key(cell)]
+		written = record.get('written', {'trials': 0, 'hits': 0.0, 'runtime': 0.0})
+		if written is True:
+			# Older checkpoints only marked the cell as written
+			written = dict((name, record[name]) for name in ['trials', 'hits', 'runtime'])
+		return written
+
+	def record(self, cell):
+		''' Result record of the cell's trials that were not written out yet,
+		or None if there are none. Records of the same cell add up in
+		load_results, so a sweep resumed with more trials appends only the new
+		ones. '''
+		record = self.state['cells'][cell_key(cell)]
+		written = self.written(cell)
+		if record['trials'] <= written['trials']:
+			return None
+		return make_record(cell['protocol'], cell['estimator'], cell['degree'], cell['spreading_time'],
+						   record['trials'] - written['trials'], record['hits'] - written['hits'],
+						   record['runtime'] - written['runtime'], self.seed())
+
+	def mark_written(self, cell):
+		record = self.state['cells'][cell_key(cell)]
+		record['written'] = dict((name, record[name]) for name in ['trials', 'hits', 'runtime'])
+
+	def accuracy(self, cell):
+		record = self.state['cells'][cell_key(cell)]
+		return record['hits'] / record['trials']
+
+	def save(self):
+		tmp_path = self.path + '.tmp'
+		with open(tmp_path, 'w') as f:
+			json.dump(self.state, f, indent = 1, sort_keys = True)
+		os.rename(tmp_path, self.path)
+
+
+def write_cell(checkpoint, cell, output):
+	''' Appends the record of a finished cell's unwritten trials to output '''
+	record = checkpoint.record(cell)
+	if record is not None:
+		append_results(output, [record])
+		checkpoint.mark_written(cell)
+		checkpoint.save()
+
+def run_sweep(cells, trials, checkpoint, output, workers = 1):
+	''' Runs trials of every cell, biggest cells first, skipping the trials that
+	the checkpoint already has, and appends each finished cell to the results
+	file output. Blocks start at multiples of the checkpoint's block size and
+	every trial is seeded on its own, so a resumed sweep gives the same results
+	as an uninterrupted one. '''
+	cells = sorted(cells, key = cell_cost, reverse = True)
+	block_size = checkpoint.block_size()
+	tasks = []
+	for cell in cells:
+		for start in range(checkpoint.trials_done(cell), trials, block_size):
+			tasks += [(cell, checkpoint.seed(), start, min(block_size, trials - start))]
+	print 'Cells left: ', len(set([cell_key(task[0]) for task in tasks])), ' out of ', len(cells)
+
+	pool = None
+	if workers > 1:
+		pool = multiprocessing.Pool(workers)
+		results = pool.imap(run_cell_block, tasks)
+	else:
+		results = itertools.imap(run_cell_block, tasks)
+
+	# An earlier run may have stopped between finishing a cell and writing it
+	for cell in cells:
+		if checkpoint.trials_done(cell) >= trials:
+			write_cell(checkpoint, cell, output)
+
+	for (task, (hits, runtime)) in itertools.izip(tasks, results):
+		(cell, seed, start, count) = task
+		checkpoint.add(cell, count, hits, runtime)
+		checkpoint.save()
+		if checkpoint.trials_done(cell) >= trials:
+			print 'Finished ', cell_key(cell), ' accuracy: ', checkpoint.accuracy(cell)
+			write_cell(checkpoint, cell, output)
+
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+
+if __name__ == "__main__":
+
+	args = parse_sweep_arguments()
+
+	cells = make_grid(args.degrees, args.spreading_times, args.protocols, args.estimators)
+	checkpoint = Checkpoint(args.checkpoint, args.seed, args.block_size)
+	run_sweep(cells, args.trials, checkpoint, args.output, args.workers)
+
+	for cell in sorted(cells, key = cell_key):
+		print cell_key(cell), ': ', checkpoint.accuracy(cell)
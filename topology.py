@@ -0,0 +1,45 @@
+# topology.py
+
+from runner import *
+from utils import *
+import itertools
+import multiprocessing
+import time
+
+
+if __name__ == "__main__":
+
+	args = parse_topology_arguments()
+	np.random.seed(args.seed)
+
+	# Convert or generate the topology once; workers memory-map the saved copy
+	if args.edges is not None:
+		CSRGraph.from_edge_list(args.edges).save(args.graph_dir)
+	elif args.random is not None:
+		random_regular_graph(*args.random).save(args.graph_dir)
+	graph = shared_graph(args.graph_dir)
+	print 'Nodes: ', graph.number_of_nodes(), ' edges: ', graph.number_of_edges()
+
+	cells = [(protocol, estimator, spreading_time)
+			 for (protocol, estimator, spreading_time) in itertools.product(args.protocols, args.estimators, args.spreading_times)
+			 if estimator in GRAPH_ESTIMATORS[protocol]]
+	tasks = [(args.graph_dir, protocol, estimator, spreading_time, args.seed, start,
+			  min(args.block_size, args.trials - start))
+			 for (protocol, estimator, spreading_time) in cells for start in range(0, args.trials, args.block_size)]
+
+	start_time = time.time()
+	if args.workers > 1:
+		pool = multiprocessing.Pool(args.workers)
+		hits = pool.map(run_graph_block, tasks)
+		pool.close()
+		pool.join()
+	else:
+		hits = map(run_graph_block, tasks)
+
+	blocks = len(range(0, args.trials, args.block_size))
+	for (i, (protocol, estimator, spreading_time)) in enumerate(cells):
+		total = sum(hits[i * blocks:(i + 1) * blocks])
+		(center, half_width) = wilson_interval(total, args.trials)
+		print '[%s] spreading time %d: %s accuracy %.4f (95%% CI %.4f-%.4f)' % (
+			protocol, spreading_time, estimator, total / args.trials, center - half_width, center + half_width)
+	print 'The runtime is ', time.time() - start_time
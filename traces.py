@@ -0,0 +1,161 @@
+# traces.py
+
+from graph_rep import *
+import json
+import numpy as np
+import os
+import struct
+
+MAGIC = 'P2PTRACE'
+VERSION = 1
+
+# Per-node arrays stored for each protocol, with their on-disk dtypes. The
+# infection order is given by the infection (receive) times.
+TRACE_FIELDS = {
+	'gossip': [('parent', '<i4'), ('ring', '<i4'), ('infect_time', '<i4'), ('report_time', '<i4')],
+	'diffusion': [('parent', '<i4'), ('ring', '<i4'), ('received_timestamps', '<f8'),
+				  ('adversary_timestamps', '<f8')],
+}
+
+# One row per trial: where its arrays start, and what the arrays do not hold
+INDEX_DTYPE = np.dtype([('start', '<i8'), ('num_nodes', '<i8'), ('source', '<i8'), ('degree', '<i8'),
+						('spreading_time', '<i8'), ('horizon', '<f8')])
+
+# Footer: index offset, header length, magic
+FOOTER = struct.Struct('<QQ8s')
+
+def padded(nbytes):
+	''' Arrays start at multiples of 8 bytes '''
+	return (nbytes + 7) // 8 * 8
+
+def trace_protocol(G):
+	if isinstance(G, RegularTreeGossip):
+		return 'gossip'
+	if isinstance(G, (RegularTreeDiffusion, RegularTreeDiffusionEvents)):
+		return 'diffusion'
+	raise TypeError('cannot trace a %s' % type(G).__name__)
+
+
+class TraceWriter(object):
+	''' Appends spread trials of one protocol to a binary trace file. Each
+	trial's per-node arrays (TRACE_FIELDS) are written one after the other as
+	soon as it is added; close writes the index of the trials and a JSON
+	header at the end of the file.
+
+	File layout: magic, the trials' arrays, the index (one INDEX_DTYPE row per
+	trial), the header, and a fixed-size footer that locates the index. '''
+
+	def __init__(self, filename, protocol):
+		directory = os.path.dirname(filename)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		self.filename = filename
+		self.protocol = protocol
+		self.fields = TRACE_FIELDS[protocol]
+		self.rows = []
+		self.lambdas = None
+		self.file = open(filename, 'wb')
+		self.file.write(MAGIC)
+		self.offset = len(MAGIC)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc_info):
+		self.close()
+		return False
+
+	def add(self, G):
+		''' Appends a trial that has spread '''
+		if trace_protocol(G) != self.protocol:
+			raise ValueError('a %s trace cannot hold a %s trial' % (self.protocol, trace_protocol(G)))
+		if G.num_nodes >= 2**31:
+			raise ValueError('trials of 2**31 nodes or more cannot be traced')
+		if self.protocol == 'diffusion':
+			lambdas = (G.lambda1, G.lambda2)
+			if self.lambdas not in (None, lambdas):
+				raise ValueError('all the trials of a trace must have the same delays')
+			self.lambdas = lambdas
+
+		start = self.offset
+		for (name, dtype) in self.fields:
+			data = np.ascontiguousarray(getattr(G, name)[:G.num_nodes], dtype = dtype).tostring()
+			self.file.write(data + '\0' * (padded(len(data)) - len(data)))
+			self.offset += padded(len(data))
+		spreading_time = -1 if (G.spreading_time is None) else G.spreading_time
+		self.rows += [(start, G.num_nodes, G.source, G.tree_degree, spreading_time,
+					   getattr(G, 'horizon', np.inf))]
+
+	def close(self):
+		if self.file is None:
+			return
+		index = np.array(self.rows, dtype = INDEX_DTYPE)
+		header = json.dumps({'version': VERSION, 'protocol': self.protocol, 'trials': len(index),
+							 'fields': self.fields, 'lambdas': self.lambdas})
+		self.file.write(index.tostring())
+		self.file.write(header)
+		self.file.write(FOOTER.pack(self.offset, len(header), MAGIC))
+		self.file.close()
+		self.file = None
+
+
+class TraceReader(object):
+	''' Reads a trace file written by TraceWriter. With mmap, the file stays
+	on disk and each trial's arrays are read-only views of it, so replaying a
+	trial costs little more than rebuilding its Observation, and processes that
+	read the same file share its pages. '''
+
+	def __init__(self, filename, mmap = True):
+		if mmap:
+			self.data = np.memmap(filename, dtype = np.uint8, mode = 'r')
+		else:
+			self.data = np.fromfile(filename, dtype = np.uint8)
+		if (len(self.data) < len(MAGIC) + FOOTER.size) or (self.data[:len(MAGIC)].tostring() != MAGIC):
+			raise ValueError('%s is not a trace file' % filename)
+		(index_offset, header_length, magic) = FOOTER.unpack(self.data[-FOOTER.size:].tostring())
+		if magic != MAGIC:
+			raise ValueError('%s is not a complete trace file' % filename)
+
+		header_offset = len(self.data) - FOOTER.size - header_length
+		header = json.loads(self.data[header_offset:header_offset + header_length].tostring())
+		if header['version'] != VERSION:
+			raise ValueError('trace version %d is not supported' % header['version'])
+		self.protocol = str(header['protocol'])
+		self.fields = [(str(name), np.dtype(str(dtype))) for (name, dtype) in header['fields']]
+		self.lambdas = header['lambdas']
+		self.index = self.data[index_offset:header_offset].view(INDEX_DTYPE)
+
+	def __len__(self):
+		return len(self.index)
+
+	def arrays(self, trial):
+		''' Dict of the per-node arrays of a trial '''
+		row = self.index[trial]
+		arrays = {}
+		offset = int(row['start'])
+		for (name, dtype) in self.fields:
+			nbytes = int(row['num_nodes']) * dtype.itemsize
+			arrays[name] = self.data[offset:offset + nbytes].view(dtype)
+			offset += padded(nbytes)
+		return arrays
+
+	def trial(self, trial):
+		''' Rebuilds a trial as the spread graph that estimators take '''
+		row = self.index[trial]
+		(degree, spreading_time) = (int(row['degree']), int(row['spreading_time']))
+		arrays = self.arrays(trial)
+		if self.protocol == 'gossip':
+			arrays['infected'] = arrays['infect_time'] >= 0
+			G = RegularTreeGossip.from_arrays(degree, spreading_time, arrays)
+		else:
+			arrays['infected'] = np.isfinite(arrays['received_timestamps'])
+			G = RegularTreeDiffusion.from_arrays(degree, None if (spreading_time < 0) else spreading_time,
+												 arrays, float(row['horizon']))
+			(G.lambda1, G.lambda2) = self.lambdas
+		G.source = int(row['source'])
+		return G
+
+	def trials(self, start = 0, stop = None):
+		''' Yields the trials from start to stop, rebuilt '''
+		for trial in xrange(*slice(start, stop).indices(len(self))):
+			yield self.trial(trial)
@@ -1,34 +1,85 @@
 # utils.py
 import argparse
+import json
+import numpy as np
+import os
+import random
+import time
 
-def write_results(results_names, results_data, param_types, params, run_num = None):
-	''' Writes a file containing the parameters, then prints each
-	result name with the corresponding data '''
+# Fields of a result record, with their array dtypes
+RESULT_FIELDS = [('protocol', 'S16'), ('estimator', 'S16'), ('degree', int),
+				 ('spreading_time', int), ('horizon', float), ('max_observations', float),
+				 ('trials', int), ('hits', float), ('runtime', float), ('seed', int)]
 
-	filename = 'results/results' + "_".join([str(i) for i in params[0]])
+# Fields that tell cells apart: records that agree on all of them are merged
+CELL_FIELDS = ['protocol', 'estimator', 'degree', 'spreading_time', 'horizon', 'max_observations']
 
+def results_filename(run_num = None):
+	filename = 'results/results'
 	if not (run_num is None):
 		filename += '_run' + str(run_num)
+	return filename + '.jsonl'
 
+def make_record(protocol, estimator, degree, spreading_time, trials, hits, runtime, seed,
+				horizon = None, max_observations = None):
+	''' One finished cell: hits is the sum of the per-trial accuracies. An
+	event-driven diffusion cell has a horizon or max_observations (None
+	otherwise), and a spreading_time of -1 if its rings are unbounded. '''
+	return {'protocol': protocol, 'estimator': estimator, 'degree': degree,
+			'spreading_time': spreading_time, 'horizon': horizon, 'max_observations': max_observations,
+			'trials': trials, 'hits': hits, 'runtime': runtime, 'seed': seed, 'time': time.time()}
 
-	f = open(filename, 'w')
+def append_results(filename, records):
+	''' Appends one JSON line per record. Earlier records are never rewritten,
+	so each call costs O(new records). '''
+	directory = os.path.dirname(filename)
+	if directory and not os.path.exists(directory):
+		os.makedirs(directory)
+	with open(filename, 'a') as f:
+		for record in records:
+			f.write(json.dumps(record, sort_keys = True) + '\n')
 
-	for (param_type, param) in zip(param_types, params):
-		f.write(param_type)
-		f.write(': ')
-		for item in param:
-		  f.write("%s " % item)		
-		f.write('\n')
+def wilson_interval(hits, trials, z = 1.96):
+	''' Center and half-width of the Wilson score interval of an accuracy of
+	hits / trials (scalars or arrays) at z standard deviations '''
+	n = np.asarray(trials, dtype = float)
+	p = hits / n
+	center = (p + z**2 / (2 * n)) / (1 + z**2 / n)
+	half_width = z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / (1 + z**2 / n)
+	return (center, half_width)
 
-	for (result_type, result) in zip(results_names, results_data):
-		f.write(result_type)
-		f.write('\n')
+def load_results(filename, combine = True, z = 1.96):
+	''' Returns a dict of NumPy arrays, one entry per record, with the fields
+	of RESULT_FIELDS plus the accuracy and the bounds of its Wilson score
+	interval at z standard deviations (horizon and max_observations are NaN
+	where unset). If combine is set, records of the same cell (CELL_FIELDS)
+	are merged by adding their trials, hits and runtimes (their seed is then
+	-1 if they differ). '''
+	with open(filename) as f:
+		records = [json.loads(line) for line in f if line.strip()]
 
-		for item in result:
-		  f.write("%s " % item)
-	  	f.write('\n')
+	if combine:
+		merged = {}
+		for record in records:
+			key = tuple(record.get(name) for name in CELL_FIELDS)
+			if key not in merged:
+				merged[key] = dict(record)
+				continue
+			for name in ['trials', 'hits', 'runtime']:
+				merged[key][name] += record[name]
+			if merged[key]['seed'] != record['seed']:
+				merged[key]['seed'] = -1
+		records = [merged[key] for key in sorted(merged)]
 
-	f.close()
+	results = {}
+	for (name, dtype) in RESULT_FIELDS:
+		results[name] = np.array([record.get(name) for record in records], dtype = dtype)
+
+	(center, half_width) = wilson_interval(results['hits'], results['trials'], z)
+	results['accuracy'] = results['hits'] / results['trials']
+	results['ci_low'] = center - half_width
+	results['ci_high'] = center + half_width
+	return results
 
 def parse_arguments():
 	parser = argparse.ArgumentParser()
@@ -42,14 +93,269 @@ def parse_arguments():
 						default=1)
 	parser.add_argument("--measure_time", help="measure runtime?",
 						action="store_true")
+	parser.add_argument("-b", "--batch", help="simulate the diffusion trials in batches",
+						action="store_true")
+	parser.add_argument("--batch_size", type=int, help="number of diffusion trials per batch",
+						default=10000)
+	parser.add_argument("--rings", type=int, help="number of diffusion rings",
+						default=4)
+	parser.add_argument("--stream", help="simulate the diffusion trials without storing the tree (overrides --batch)",
+						action="store_true")
+	parser.add_argument("--horizon", type=float,
+						help="simulate the diffusion event by event until this time, with unbounded rings (overrides --rings, --batch and --stream)")
+	parser.add_argument("--max_observations", type=int,
+						help="simulate the diffusion event by event until this many adversary timestamps, with unbounded rings")
+	parser.add_argument("--diffusion_ml", help="also run the ML estimator over all the diffusion timestamps",
+						action="store_true")
+	parser.add_argument("--reroot", help="score all ML candidates from shared edge messages (same estimates, recorded as ml-reroot)",
+						action="store_true")
+	parser.add_argument("--log_counts", help="keep ML path counts as scaled floats instead of exact integers",
+						action="store_true")
+	parser.add_argument("--branch_and_bound", help="skip ML candidates whose count bound is below the best count",
+						action="store_true")
+	parser.add_argument("--sampled_ml", help="estimate the ML counts by sampling instead of counting exactly",
+						action="store_true")
+	parser.add_argument("--ml_samples", type=int, help="samples per candidate of the sampled ML estimator",
+						default=1000)
+	parser.add_argument("--ml_time_budget", type=float, help="seconds per trial of the sampled ML estimator")
+	parser.add_argument("-p", "--workers", type=int, help="number of worker processes",
+						default=1)
+	parser.add_argument("-s", "--seed", type=int, help="base random seed of the trials")
+	parser.add_argument("--ci_half_width", type=float,
+						help="stop each degree and estimator once the 95%% interval of its accuracy is this narrow; --trials is then the maximum")
+	parser.add_argument("--profile", help="time each stage and count the estimator's work",
+						action="store_true")
+	parser.add_argument("--profile_output", help="file to save the profile to (JSON)")
 	args = parser.parse_args()
 
 	if not (args.run is None):
 		args.write = True
+	if not (args.profile_output is None):
+		args.profile = True
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31 - 1)
 
 	print '---Selected Parameters---'
 	print 'verbose: ', args.verbose
 	print 'write to file: ', args.write
 	print 'run: ', args.run
+	print 'num trials: ', args.trials
+	print 'target CI half-width: ', args.ci_half_width
+	print 'batched diffusion: ', args.batch
+	print 'streamed diffusion: ', args.stream
+	print 'diffusion rings: ', args.rings
+	print 'diffusion horizon: ', args.horizon
+	print 'diffusion observations: ', args.max_observations
+	print 'diffusion ML: ', args.diffusion_ml
+	print 'rerooted ML: ', args.reroot
+	print 'log-domain ML counts: ', args.log_counts
+	print 'branch and bound ML: ', args.branch_and_bound
+	print 'sampled ML: ', args.sampled_ml
+	print 'workers: ', args.workers
+	print 'profile: ', args.profile
+	print 'seed: ', args.seed, '\n'
+	return args
+
+def parse_sweep_arguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-c", "--checkpoint", help="checkpoint file; an existing one is resumed",
+						default="sweep_checkpoint.json")
+	parser.add_argument("-d", "--degrees", type=int, nargs="+", help="tree degrees",
+						default=range(2,10))
+	parser.add_argument("--spreading_times", type=int, nargs="+",
+						help="spreading times (rounds for gossip, rings for diffusion)", default=[4])
+	parser.add_argument("--protocols", nargs="+", help="spreading protocols",
+						default=['gossip', 'diffusion'])
+	parser.add_argument("-e", "--estimators", nargs="+", help="estimators",
+						default=['first-spy'])
+	parser.add_argument("-t","--trials", type=int, help="number of trials per cell",
+						default=1)
+	parser.add_argument("--block_size", type=int, help="number of trials between checkpoints",
+						default=100)
+	parser.add_argument("-p", "--workers", type=int, help="number of worker processes",
+						default=1)
+	parser.add_argument("-s", "--seed", type=int, help="base random seed of a new sweep")
+	parser.add_argument("-o", "--output", help="results file that finished cells are appended to",
+						default="results/sweep.jsonl")
+	args = parser.parse_args()
+
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31 - 1)
+
+	print '---Selected Parameters---'
+	print 'checkpoint: ', args.checkpoint
+	print 'results: ', args.output
+	print 'degrees: ', args.degrees
+	print 'spreading times: ', args.spreading_times
+	print 'protocols: ', args.protocols
+	print 'estimators: ', args.estimators
+	print 'num trials: ', args.trials, '\n'
+	return args
+
+def parse_benchmark_arguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-b", "--benchmarks", nargs="+", help="benchmarks to run",
+						default=['diffusion-spread', 'gossip-spread', 'first-spy', 'first-spy-diffusion', 'ml', 'ml-mp', 'ml-mp-log'])
+	parser.add_argument("-d", "--degrees", type=int, nargs="+", help="tree degrees",
+						default=[3, 5, 8])
+	parser.add_argument("--gossip_times", type=int, nargs="+", help="gossip spreading times",
+						default=[5, 8])
+	parser.add_argument("--diffusion_rings", type=int, nargs="+", help="diffusion rings",
+						default=[3, 4])
+	parser.add_argument("-r", "--repeats", type=int, help="runs of each case",
+						default=5)
+	parser.add_argument("-s", "--seed", type=int, help="random seed",
+						default=0)
+	parser.add_argument("-o", "--output", help="file to save the results to (JSON)")
+	parser.add_argument("--baseline", help="earlier results file to compare against")
+	parser.add_argument("--threshold", type=float, help="time ratio reported as a regression",
+						default=1.2)
+	args = parser.parse_args()
+
+	print '---Selected Parameters---'
+	print 'benchmarks: ', args.benchmarks
+	print 'degrees: ', args.degrees
+	print 'gossip times: ', args.gossip_times
+	print 'diffusion rings: ', args.diffusion_rings
+	print 'repeats: ', args.repeats, '\n'
+	return args
+
+def parse_topology_arguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-g", "--graph_dir", help="directory of the saved topology (.npy files)",
+						default="topologies/graph")
+	parser.add_argument("--edges", help="edge list to convert and save to graph_dir")
+	parser.add_argument("--random", type=int, nargs=2, metavar=("NODES", "DEGREE"),
+						help="generate a random regular graph and save it to graph_dir")
+	parser.add_argument("--spreading_times", type=int, nargs="+",
+						help="spreading times (rounds for gossip, hops for diffusion)", default=[4])
+	parser.add_argument("--protocols", nargs="+", help="spreading protocols",
+						default=['gossip', 'diffusion'])
+	parser.add_argument("-e", "--estimators", nargs="+",
+						help="estimators (ml: the timestamp-consistent candidates, gossip only)",
+						default=['first-spy'])
+	parser.add_argument("-t","--trials", type=int, help="number of trials",
+						default=100)
+	parser.add_argument("--block_size", type=int, help="number of trials per task",
+						default=100)
+	parser.add_argument("-p", "--workers", type=int, help="number of worker processes",
+						default=1)
+	parser.add_argument("-s", "--seed", type=int, help="base random seed of the trials")
+	args = parser.parse_args()
+
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31 - 1)
+
+	print '---Selected Parameters---'
+	print 'topology: ', args.graph_dir
+	print 'edge list: ', args.edges
+	print 'random regular graph: ', args.random
+	print 'spreading times: ', args.spreading_times
+	print 'protocols: ', args.protocols
+	print 'estimators: ', args.estimators
+	print 'num trials: ', args.trials
+	print 'seed: ', args.seed, '\n'
+	return args
+
+def parse_replay_arguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-f", "--trace", help="trace file",
+						default="traces/trace.bin")
+	parser.add_argument("--record", help="spread new trials into the trace file first (replacing it)",
+						action="store_true")
+	parser.add_argument("--protocol", help="spreading protocol of the recorded trials",
+						choices=['gossip', 'diffusion'], default='gossip')
+	parser.add_argument("-d", "--degrees", type=int, nargs="+", help="tree degrees of the recorded trials",
+						default=range(2,10))
+	parser.add_argument("--spreading_time", type=int,
+						help="spreading time of the recorded trials (default: degree + 3 rounds for gossip, 4 rings for diffusion)")
+	parser.add_argument("--horizon", type=float,
+						help="record event-driven diffusion trials that stop at this time")
+	parser.add_argument("--check", help="check that the recorded trials give the same estimates after replay",
+						action="store_true")
+	parser.add_argument("-t","--trials", type=int, help="number of recorded trials per degree",
+						default=100)
+	parser.add_argument("-e", "--estimators", nargs="+", help="estimators to replay the trials into",
+						default=['first-spy'])
+	parser.add_argument("--block_size", type=int, help="number of trials per task",
+						default=100)
+	parser.add_argument("-p", "--workers", type=int, help="number of worker processes",
+						default=1)
+	parser.add_argument("-s", "--seed", type=int, help="base random seed of the recorded trials")
+	args = parser.parse_args()
+
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31 - 1)
+
+	print '---Selected Parameters---'
+	print 'trace: ', args.trace
+	print 'record: ', args.record
+	if args.record:
+		print 'protocol: ', args.protocol
+		print 'degrees: ', args.degrees
+		print 'spreading time: ', args.spreading_time
+		print 'horizon: ', args.horizon
+		print 'num trials: ', args.trials
+		print 'seed: ', args.seed
+	print 'estimators: ', args.estimators, '\n'
+	return args
+
+def parse_curve_arguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-d", "--degrees", type=int, nargs="+", help="tree degrees",
+						default=range(2,10))
+	parser.add_argument("-T", "--max_time", type=int,
+						help="longest spreading time (rounds for gossip, rings for diffusion)", default=8)
+	parser.add_argument("--protocols", nargs="+", help="spreading protocols",
+						default=['gossip', 'diffusion'])
+	parser.add_argument("-e", "--estimators", nargs="+", help="estimators",
+						default=['first-spy'])
+	parser.add_argument("-t","--trials", type=int, help="number of trials per curve",
+						default=100)
+	parser.add_argument("--block_size", type=int, help="number of trials per task",
+						default=100)
+	parser.add_argument("-p", "--workers", type=int, help="number of worker processes",
+						default=1)
+	parser.add_argument("-s", "--seed", type=int, help="base random seed")
+	parser.add_argument("-o", "--output", help="results file that the points of the curves are appended to",
+						default="results/curves.jsonl")
+	args = parser.parse_args()
+
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31 - 1)
+
+	print '---Selected Parameters---'
+	print 'results: ', args.output
+	print 'degrees: ', args.degrees
+	print 'max spreading time: ', args.max_time
+	print 'protocols: ', args.protocols
+	print 'estimators: ', args.estimators
+	print 'num trials: ', args.trials, '\n'
+	return args
+
+def parse_analytic_arguments():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-d", "--degrees", type=int, nargs="+", help="tree degrees",
+						default=range(2,10))
+	parser.add_argument("--spreading_times", type=int, nargs="+",
+						help="spreading times (rounds for gossip, rings for diffusion)", default=[4])
+	parser.add_argument("--protocols", nargs="+", help="spreading protocols",
+						default=['gossip', 'diffusion'])
+	parser.add_argument("--tol", type=float, help="numerical tolerance of the accuracies",
+						default=1e-9)
+	parser.add_argument("-t","--trials", type=int,
+						help="number of simulated trials per cell to cross-check against (0 for none)",
+						default=0)
+	parser.add_argument("-s", "--seed", type=int, help="base random seed of the simulated trials")
+	args = parser.parse_args()
+
+	if args.seed is None:
+		args.seed = random.randint(0, 2**31 - 1)
+
+	print '---Selected Parameters---'
+	print 'degrees: ', args.degrees
+	print 'spreading times: ', args.spreading_times
+	print 'protocols: ', args.protocols
+	print 'tolerance: ', args.tol
 	print 'num trials: ', args.trials, '\n'
 	return args